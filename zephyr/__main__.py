@@ -7,6 +7,8 @@ import sys
 from cement.core.foundation import CementApp
 from cement.utils.misc import init_defaults
 
+from .core.aws import uploader
+from .core.client import Client
 from .core.configure import CONFIG_PATH, CRED_ITEMS, DEFAULTS
 from .core.utils import ZephyrException
 from .cli.controllers import __ALL__ as ZephyrControllers
@@ -30,6 +32,10 @@ class Zephyr(CementApp):
         output_handler = "default" # See .cli.output
         log_handler = "colorlog"
 
+    # Commands which fetch responses set this, so that the local cache is
+    # kept within its size limit once they are done.
+    fetched = False
+
     def configure(self):
         for section, keys in CRED_ITEMS:
             for key in keys:
@@ -38,6 +44,20 @@ class Zephyr(CementApp):
                     self.config.set(section, key, env)
 
 
+def tidy(app):
+    """
+    Wait for the uploads queued in the background, then keep the local cache
+    within its size limit if the command fetched responses. Failures are
+    logged rather than raised, so that they never hide the command's own.
+    """
+    try:
+        uploader.drain_all()
+        if app.fetched:
+            Client(app.config, log=app.log).evict_cache()
+    except Exception as e:
+        app.log.warning("Could not tidy the local cache: {}".format(e))
+
+
 def main():
     with Zephyr() as app:
         app.configure()
@@ -47,6 +67,8 @@ def main():
             message = e.args[0]
             app.log.error(message)
             sys.exit(1)
+        finally:
+            tidy(app)
 
 
 if __name__ == "__main__":
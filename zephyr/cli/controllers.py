@@ -4,7 +4,7 @@ import sys
 
 from cement.core.controller import CementBaseController, expose
 
-from ..core import meta
+from ..core import meta, pool, sessions, warm
 from ..core.book import Book
 from ..core.client import Client
 from ..core.configure import create_config
@@ -41,6 +41,98 @@ class ZephyrCLI(CementBaseController):
         sys.exit(0)
 
 
+class ZephyrCache(ZephyrCLI):
+    class Meta:
+        label = "cache"
+        stacked_on = "base"
+        stacked_type = "nested"
+        description = "Manage the local and S3 response cache."
+        arguments = ZephyrCLI.Meta.arguments
+
+
+class ZephyrCacheMigrate(ZephyrCache):
+    class Meta:
+        label = "migrate"
+        stacked_on = "cache"
+        stacked_type = "nested"
+        description = "Compress cached responses written in the old format."
+        arguments = ZephyrCache.Meta.arguments + [(
+            ["--s3"], dict(
+                action="store_true",
+                help="Also compress the responses cached in S3."
+            )
+        )]
+
+    @expose(hide=True)
+    def default(self):
+        self.run(**vars(self.app.pargs))
+
+    def run(self, **kwargs):
+        self.app.fetched = True
+        client = Client(self.app.config, log=self.app.log)
+        client.migrate_cache_local()
+        if self.app.pargs.s3:
+            client.migrate_cache_s3()
+
+
+class ZephyrCacheWarm(ZephyrCache):
+    class Meta:
+        label = "warm"
+        stacked_on = "cache"
+        stacked_type = "nested"
+        description = "Fetch the responses reports need into the cache."
+        arguments = ZephyrCache.Meta.arguments + [(
+            ["--account"], dict(
+                type=str,
+                help="The desired account slug."
+            ),
+        ),
+        (
+            ["--all"], dict(
+                action="store_true",
+                help="Run for all accounts."
+            )
+        ),
+        (
+            ["--calls"], dict(
+                nargs="+",
+                help="Only warm these calls, e.g. compute-details billing."
+            )
+        ),
+        (
+            ["--date"], dict(
+                type=str,
+                help="The report date to request."
+            ),
+        )]
+
+    @expose(hide=True)
+    def default(self):
+        self.run(**vars(self.app.pargs))
+
+    def run(self, **kwargs):
+        config = self.app.config
+        log = self.app.log
+        account = self.app.pargs.account
+        all_ = self.app.pargs.all
+        date = self.app.pargs.date
+        if not any((account, all_)):
+            self.app.args.print_help()
+            sys.exit(0)
+        # If no date is given then default to the first of last month.
+        if(not date):
+            date = first_of_previous_month().strftime("%Y-%m-%d")
+        calls = warm.get_calls(report_sheets(), slugs=self.app.pargs.calls)
+        self.app.fetched = True
+        client = Client(config, log=log)
+        accts = [account]
+        if all_:
+            accts = client.get_slugs()
+        # Every call checks S3 against this one listing.
+        client.sync_manifest()
+        return warm.Warmer(config, calls, log=log).warm(accts, date)
+
+
 class ZephyrClearCache(ZephyrCLI):
     class Meta:
         label = "clear-cache"
@@ -64,6 +156,12 @@ class ZephyrClearCache(ZephyrCLI):
                 type=str,
                 help="The report date to request."
             ),
+        ),
+        (
+            ["--month"], dict(
+                type=str,
+                help="The month to clear as YYYY-MM, instead of --date."
+            ),
         )]
 
     @expose(hide=True)
@@ -76,23 +174,38 @@ class ZephyrClearCache(ZephyrCLI):
         account = self.app.pargs.account
         all_ = self.app.pargs.all
         date = self.app.pargs.date
-        if not any((account, date, all_)):
+        month = self.app.pargs.month
+        if not any((account, date, month, all_)):
             self.app.args.print_help()
             sys.exit(0)
-        if not (date and any((account, all_))):
+        if not (any((date, month)) and any((account, all_))):
             raise ZephyrException("Account and date are required parameters.")
 
-        month = datetime.datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m")
+        if(date):
+            month = datetime.datetime.strptime(
+                date, "%Y-%m-%d"
+            ).strftime("%Y-%m")
+        try:
+            month = datetime.datetime.strptime(
+                month, "%Y-%m"
+            ).strftime("%Y-%m")
+        except ValueError:
+            raise ZephyrException(
+                "The month must be given as YYYY-MM, not {}.".format(month)
+            )
         client = Client(config, log=log)
-        accts = [account]
         if(all_):
-            accts = client.get_slugs()
-        for acct in accts:
-            if(not client.get_account_by_slug(acct)):
-                log.info("Skipping {}".format(acct))
-                continue
-            client.clear_cache_s3(acct, month)
-            client.clear_cache_local(acct, month)
+            # One listing of the bucket covers every account.
+            client.clear_cache_s3_month(month)
+            client.clear_cache_local_month(month)
+            return
+        if(not client.get_account(account)):
+            log.warning("Skipping {}, which is not a known account.".format(
+                account
+            ))
+            return
+        client.clear_cache_s3(account, month)
+        client.clear_cache_local(account, month)
 
 
 class ZephyrConfigure(ZephyrCLI):
@@ -288,6 +401,12 @@ class ZephyrReport(ZephyrCLI):
                 action="store_true",
                 help="Forces the cached data to be refreshed."
             )
+        ),
+        (
+            ["--workers"], dict(
+                type=int,
+                help="Run accounts across this many worker processes."
+            )
         )]
 
 
@@ -295,10 +414,16 @@ class SheetRun(ZephyrReport):
     class Meta:
         stacked_on = "report"
 
+    # The sheets of the report, in the order of the book.
+    sheets = ()
+
     @expose(hide=True)
     def default(self):
         self.run(**vars(self.app.pargs))
 
+    def run(self, **kwargs):
+        self._run(*self.sheets)
+
     def alert_config_missing(self, acct, missing):
         if not self.app.pargs.all:
             raise ZephyrException(
@@ -319,6 +444,7 @@ class SheetRun(ZephyrReport):
         date = self.app.pargs.date
         expire_cache = self.app.pargs.expire_cache
         in_memory = self.app.pargs.output_handler_override
+        workers = self.app.pargs.workers
         if not any((account, date, expire_cache, all_)):
             self.app.args.print_help()
             sys.exit(0)
@@ -327,10 +453,22 @@ class SheetRun(ZephyrReport):
         # If no date is given then default to the first of last month.
         if(not date):
             date = first_of_previous_month().strftime("%Y-%m-%d")
+        self.app.fetched = True
         client = Client(config, log=log)
         accts = [account]
         if all_:
             accts = client.get_slugs()
+        if workers:
+            if in_memory:
+                raise ZephyrException(
+                    "The --workers option writes .xlsx files and cannot be "
+                    "combined with an output handler."
+                )
+            # Workers reuse this listing rather than each listing S3.
+            client.sync_manifest()
+            return pool.run_accounts(
+                config, log, label, sheets, accts, date, expire_cache, workers
+            )
         for acct in accts:
             book = Book(
                 config,
@@ -343,11 +481,7 @@ class SheetRun(ZephyrReport):
                 in_memory=in_memory,
             )
             if not book.slug_valid(acct):
-                missing = ", ".join({
-                    validator.name
-                    for validator in book.slug_validators()
-                    if(not validator.get_account_by_slug(acct))
-                })
+                missing = book.missing_validators(acct)
                 self.alert_config_missing(acct, missing)
                 continue
             log.info("Running {report} for {account}".format(
@@ -359,6 +493,8 @@ class SheetRun(ZephyrReport):
             sheet_set = {bool(value) for value in out.values()}
             if not any(sheet_set):
                 self.app.log.info("No data to report for {}!".format(acct))
+        for line in sessions.format_stats(sessions.limiter_stats()):
+            log.info(line)
         if self.app.pargs.output_handler_override:
             ddh = book.sheets[0].ddh
             if ddh:
@@ -371,17 +507,16 @@ class AccountReview(SheetRun):
         label = "account-review"
         description = "Generate an account review for a given account."
 
-    def run(self, **kwargs):
-        self._run(
-            CoverPage,
-            SheetBilling,
-            SheetComputeDetails,
-            SheetDBDetails,
-            SheetComputeMigration,
-            SheetComputeRI,
-            SheetSRs,
-            SheetComputeUnderutilized,
-        )
+    sheets = (
+        CoverPage,
+        SheetBilling,
+        SheetComputeDetails,
+        SheetDBDetails,
+        SheetComputeMigration,
+        SheetComputeRI,
+        SheetSRs,
+        SheetComputeUnderutilized,
+    )
 
 
 class ComputeAV(SheetRun):
@@ -459,8 +594,7 @@ class BillingSheet(SheetRun):
         label = "billing"
         description = "Generate the compute-details worksheet."
 
-    def run(self, **kwargs):
-        self._run(SheetBilling)
+    sheets = (SheetBilling,)
 
 
 class ComputeDetailsSheet(SheetRun):
@@ -468,8 +602,7 @@ class ComputeDetailsSheet(SheetRun):
         label = "compute-details"
         description = "Generate the compute-details worksheet."
 
-    def run(self, **kwargs):
-        self._run(SheetComputeDetails)
+    sheets = (SheetComputeDetails,)
 
 
 class ComputeMigrationSheet(SheetRun):
@@ -477,8 +610,7 @@ class ComputeMigrationSheet(SheetRun):
         label = "compute-migration"
         description = "Generate the compute-migration worksheet."
 
-    def run(self, **kwargs):
-        self._run(SheetComputeMigration)
+    sheets = (SheetComputeMigration,)
 
 
 class ComputePricingSheet(SheetRun):
@@ -486,8 +618,7 @@ class ComputePricingSheet(SheetRun):
         label = "compute-pricing"
         description = "Give the list prices for instances in the environment."
 
-    def run(self, **kwargs):
-        self._run(AWSEC2PricingSheet)
+    sheets = (AWSEC2PricingSheet,)
 
 
 class ComputeRISheet(SheetRun):
@@ -495,8 +626,7 @@ class ComputeRISheet(SheetRun):
         label = "compute-ri"
         description = "Generate the compute-ri worksheet."
 
-    def run(self, **kwargs):
-        self._run(SheetComputeRI)
+    sheets = (SheetComputeRI,)
 
 
 class ComputeUnderutilizedSheet(SheetRun):
@@ -504,8 +634,7 @@ class ComputeUnderutilizedSheet(SheetRun):
         label = "compute-underutilized"
         description = "Generate the compute-underutilized worksheet"
 
-    def run(self, **kwargs):
-        self._run(SheetComputeUnderutilized)
+    sheets = (SheetComputeUnderutilized,)
 
 
 class DBDetailsSheet(SheetRun):
@@ -513,8 +642,7 @@ class DBDetailsSheet(SheetRun):
         label = "db-details"
         description = "Generate the db-details worksheet."
 
-    def run(self, **kwargs):
-        self._run(SheetDBDetails)
+    sheets = (SheetDBDetails,)
 
 
 class DBIdleSheet(SheetRun):
@@ -522,8 +650,7 @@ class DBIdleSheet(SheetRun):
         label = "db-idle"
         description = "Generate the db-idle worksheet."
 
-    def run(self, **kwargs):
-        self._run(SheetDBIdle)
+    sheets = (SheetDBIdle,)
 
 
 class IAMUsersSheet(SheetRun):
@@ -531,8 +658,7 @@ class IAMUsersSheet(SheetRun):
         label = "iam-users"
         description = "Generate the iam-users worksheet."
 
-    def run(self, **kwargs):
-        self._run(SheetIAMUsers)
+    sheets = (SheetIAMUsers,)
 
 
 class LBIdleSheet(SheetRun):
@@ -540,8 +666,7 @@ class LBIdleSheet(SheetRun):
         label = "lb-idle"
         description = "Generate the db-idle worksheet."
 
-    def run(self, **kwargs):
-        self._run(SheetLBIdle)
+    sheets = (SheetLBIdle,)
 
 
 class ServiceRequestSheet(SheetRun):
@@ -549,8 +674,7 @@ class ServiceRequestSheet(SheetRun):
         label = "service-requests"
         description = "Generate the service-requests worksheet."
 
-    def run(self, **kwargs):
-        self._run(SheetSRs)
+    sheets = (SheetSRs,)
 
 
 class StorageDetachedSheet(SheetRun):
@@ -558,8 +682,16 @@ class StorageDetachedSheet(SheetRun):
         label = "storage-detached"
         description = "List detached storage volumes."
 
-    def run(self, **kwargs):
-        self._run(SheetStorageDetached)
+    sheets = (SheetStorageDetached,)
+
+
+def report_sheets():
+    """The sheets of every report, which warming the cache covers."""
+    return [
+        Sheet
+        for Report in __ALL__ if issubclass(Report, SheetRun)
+        for Sheet in Report.sheets
+    ]
 
 
 __ALL__ = [
@@ -579,6 +711,9 @@ __ALL__ = [
     Domains,
     ServiceRequestSheet,
     ZephyrCLI,
+    ZephyrCache,
+    ZephyrCacheMigrate,
+    ZephyrCacheWarm,
     ZephyrClearCache,
     ZephyrConfigure,
     ZephyrDBRRI,
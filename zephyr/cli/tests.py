@@ -1,14 +1,21 @@
 import os
 import sqlite3
 import shutil
+import tempfile
 
 import pandas as pd
 
 from cement.utils import test
 
-from ..__main__ import Zephyr
+from ..__main__ import tidy, Zephyr
+from . import controllers
+from ..core import pool, warm
 from ..core.book import Book
-from ..core.cc.sheets import SheetComputeDetails, SheetDBDetails
+from ..core.cc.sheets import (
+    SheetComputeDetails,
+    SheetComputeUnderutilized,
+    SheetDBDetails,
+)
 from ..core.dy.sheets import SheetBilling
 from ..core.lo.sheets import SheetSRs
 from ..core.fixtures import fixtures
@@ -140,6 +147,20 @@ class TestZephyrBook(test.CementTestCase):
     def test_book_validators(self):
         assert len(self.book.slug_validators()) == 3
 
+    def test_book_shares_calls(self):
+        book = Book(
+            self.book.config,
+            "Test",
+            (SheetComputeDetails, SheetComputeUnderutilized),
+            ".meta",
+            "2001-01-01",
+            None,
+            log=self.book.log
+        )
+        details, underutilized = book.sheets
+        assert details.clients[0] is underutilized.clients[0]
+        assert details.con is underutilized.con
+
     def test_book_validators_fail(self):
         assert (
             self.book.cache_key("slug", "account", "2001-01-01") ==
@@ -262,6 +283,84 @@ class TestZephyrErrors(TestZephyrFixtures):
             "report", "billing", "--account=.no_dynamics",
         ])
 
+    def test_clear_cache_bad_month(self):
+        TestZephyr.assert_zephyr_expected_failure(self, [
+            "clear-cache", "--all", "--month=2017-13",
+        ])
+
+    def test_clear_cache_unknown_account(self):
+        cache_root = os.path.dirname(get_db_path())
+        kept = os.path.join(cache_root, "unknown", "2001-01")
+        os.makedirs(kept, exist_ok=True)
+        try:
+            with TestZephyr(argv=[
+                "clear-cache", "--account=unknown", "--month=2001-01",
+            ]) as app:
+                app.configure()
+                app.log.set_level("ERROR")
+                app.run()
+            self.eq(os.path.isdir(kept), True)
+        finally:
+            shutil.rmtree(os.path.join(cache_root, "unknown"))
+
+class TestZephyrPrefetch(TestZephyrFixtures):
+
+    def test_book_prefetch(self):
+        with self.app_class() as app:
+            app.configure()
+            app.log.set_level("ERROR")
+            config = app.config
+            log = app.log
+        date = first_of_previous_month().strftime("%Y-%m-%d")
+        book = Book(
+            config,
+            "Test",
+            (SheetComputeDetails, SheetDBDetails, SheetComputeUnderutilized),
+            ".meta",
+            date,
+            None,
+            log=log,
+        )
+        book.prefetch()
+        for sheet in book.sheets:
+            for client in sheet.clients:
+                assert client.response is not None
+
+
+class TestZephyrWorkers(TestZephyrFixtures):
+
+    def test_workers_output_handler(self):
+        TestZephyr.assert_zephyr_expected_failure(self, [
+            "report", "compute-details", "--account=.meta",
+            "--workers=2", "-o", "csv",
+        ])
+
+    def test_workers_summary(self):
+        with self.app_class() as app:
+            app.configure()
+            app.log.set_level("ERROR")
+            config = app.config
+            log = app.log
+        date = first_of_previous_month().strftime("%Y-%m-%d")
+        cwd = os.getcwd()
+        with tempfile.TemporaryDirectory() as tmp:
+            os.chdir(tmp)
+            try:
+                summary = pool.run_accounts(
+                    config,
+                    log,
+                    "compute-details",
+                    (SheetComputeDetails,),
+                    [".meta"],
+                    date,
+                    None,
+                    2,
+                )
+            finally:
+                os.chdir(cwd)
+        self.eq(summary.count(pool.REPORTED), 1)
+        self.eq(summary.failures(), [])
+
 class TestZephyrBase(test.CementTestCase):
     app_class = TestZephyr
 
@@ -269,6 +368,53 @@ class TestZephyrBase(test.CementTestCase):
         TestZephyr.assert_zephyr_success(self, [])
 
 
+class TestZephyrCacheCommands(test.CementTestCase):
+    app_class = TestZephyr
+
+    def test_tidy(self):
+        with tempfile.TemporaryDirectory() as cache_root:
+            with self.app_class() as app:
+                app.configure()
+                app.log.set_level("CRITICAL")
+                app.config.set("zephyr", "ZEPHYR_CACHE_ROOT", cache_root)
+                app.config.set("zephyr", "ZEPHYR_CACHE_SIZE_MB", "bad")
+                # Commands which fetch nothing never evict.
+                tidy(app)
+                self.eq(os.listdir(cache_root), [])
+                # Errors are logged, never raised over the command's own.
+                app.fetched = True
+                tidy(app)
+
+    def test_zephyr_cache(self):
+        TestZephyr.assert_zephyr_success(self, ["cache"])
+
+    def test_cache_migrate(self):
+        TestZephyr.assert_zephyr_success(self, [
+            "cache", "migrate", "--help",
+        ])
+
+    def test_cache_warm(self):
+        TestZephyr.assert_zephyr_success(self, [
+            "cache", "warm", "--help",
+        ])
+
+    def test_cache_warm_calls(self):
+        calls = warm.get_calls(controllers.report_sheets())
+        self.eq(sorted(Call.slug for Call in calls), [
+            "billing",
+            "compute-details",
+            "compute-migration",
+            "compute-ri",
+            "compute-underutilized",
+            "db-details",
+            "db-idle",
+            "iam-users",
+            "lb-idle",
+            "service-requests",
+            "storage-detached",
+        ])
+
+
 class TestZephyrETL(test.CementTestCase):
     app_class = TestZephyr
 
@@ -0,0 +1,100 @@
+import os
+import sqlite3
+import threading
+
+from collections import namedtuple
+from contextlib import closing
+
+Account = namedtuple("Account", (
+    "slug",
+    "aws_account",
+    "project",
+    "client",
+    "cc_name",
+    "dy_name",
+    "lo_name",
+))
+
+# The backend tables each column needs, joined on to sf_aws when present.
+JOINS = (
+    (
+        ("sf_projects",),
+        'p."Id" AS project, p."Dynamics_ID__c" AS dy_name',
+        'sf_projects AS p ON (p."Id" = aws."Assoc_Project__c")',
+    ),
+    (
+        ("sf_projects", "sf_accounts"),
+        'a."Name" AS client',
+        'sf_accounts AS a ON (a."Id" = p."Account__c")',
+    ),
+    (
+        ("cc_accounts",),
+        'c."name" AS cc_name',
+        'cc_accounts AS c ON (c."aws_account" = aws."Acct_Number__c")',
+    ),
+    (
+        ("sf_projects", "lo_accounts"),
+        'l."name" AS lo_name',
+        'lo_accounts AS l ON (p."LogicOps_ID__c" = l."id")',
+    ),
+)
+
+_indexes = dict()
+_lock = threading.Lock()
+
+
+def get_index(db_path):
+    """
+    Get the index of accounts in a metadata database, loading it once per
+    process. It is reloaded when the database changes, e.g. after meta.
+    """
+    try:
+        stat = os.stat(db_path)
+        version = (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return dict()
+    with _lock:
+        cached = _indexes.get(db_path)
+        if cached and cached[0] == version:
+            return cached[1]
+        with closing(sqlite3.connect(db_path)) as con:
+            index = load_index(con)
+        _indexes[db_path] = (version, index)
+        return index
+
+
+def get_query(tables):
+    """Select every account with the columns its tables can provide."""
+    if "sf_aws" not in tables:
+        return None
+    columns = ['aws."Name" AS slug', 'aws."Acct_Number__c" AS aws_account']
+    joins = ["sf_aws AS aws"]
+    for needs, column, join in JOINS:
+        if set(needs) <= tables:
+            columns.append(column)
+            joins.append(join)
+    return "SELECT {columns} FROM {joins} ORDER BY aws.\"Name\"".format(
+        columns=", ".join(columns),
+        joins=" LEFT OUTER JOIN ".join(joins),
+    )
+
+
+def load_index(con):
+    """Map each slug to its Account in a single query."""
+    tables = {
+        row[0] for row in con.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        )
+    }
+    query = get_query(tables)
+    if query is None:
+        return dict()
+    cursor = con.execute(query)
+    names = [column[0] for column in cursor.description]
+    index = dict()
+    for row in cursor:
+        fields = dict.fromkeys(Account._fields)
+        fields.update(zip(names, row))
+        # The first row wins where a join matches several.
+        index.setdefault(fields["slug"], Account(**fields))
+    return index
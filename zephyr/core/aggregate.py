@@ -0,0 +1,156 @@
+from collections import namedtuple
+
+COUNT = "count"
+LAST = "last"
+SUM = "sum"
+
+EQ = "="
+NE = "!="
+# Case-insensitive, as SQL's LIKE without wildcards.
+EQ_NOCASE = "= nocase"
+NE_NOCASE = "!= nocase"
+
+
+class Aggregate(namedtuple(
+    "Aggregate", ("name", "function", "columns", "expression")
+)):
+    """
+    A column of a group-by: the COUNT, SUM or LAST value of a column, or of
+    an expression over several columns. Expressions should be module level
+    functions so that equal group-bys compare and hash equal.
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, function, columns, expression=None):
+        if isinstance(columns, str):
+            columns = (columns,)
+        return super().__new__(cls, name, function, tuple(columns), expression)
+
+
+class GroupBy(namedtuple("GroupBy", (
+    "key", "aggregates", "where", "order_by", "descending", "name",
+    "expression",
+))):
+    """
+    Group rows by the values of a key column, or of an expression of it,
+    optionally keeping only the rows where a column is or is not a value,
+    compared exactly or ignoring case.
+    Groups are ordered by an output column, the first aggregate by default.
+    """
+    __slots__ = ()
+
+    def __new__(
+        cls, key, aggregates, where=None, order_by=None, descending=True,
+        name=None, expression=None,
+    ):
+        name = name or key
+        order_by = order_by or aggregates[0].name
+        return super().__new__(
+            cls, key, tuple(aggregates), where, order_by, descending, name,
+            expression,
+        )
+
+    @property
+    def header(self):
+        return [self.name] + [aggregate.name for aggregate in self.aggregates]
+
+
+def count_by(column, where=None):
+    """Count the rows of each value of a column."""
+    return GroupBy(column, (Aggregate("Total", COUNT, column),), where=where)
+
+
+def run(header, rows, group_bys):
+    """
+    Compute several group-bys of a table in a single scan of its rows.
+    Return the header and data of each group-by, by group-by. NULL (None)
+    values are left out of counts and sums, as in SQL.
+    """
+    plans = [Plan(header, group_by) for group_by in group_bys]
+    for row in rows:
+        for plan in plans:
+            plan.add(row)
+    return {plan.group_by: plan.result() for plan in plans}
+
+
+def sort_key(index):
+    # SQL puts NULLs first in ascending order and last in descending.
+    return lambda row: (row[index] is not None, row[index])
+
+
+def top(header, data, n, other="Other"):
+    """
+    Keep the first n rows and roll the rest up into an "other" row which
+    sums each of their value columns, ordered by the first of them.
+    """
+    totals = [
+        sum(row[i] for row in data[n:] if row[i] is not None)
+        for i in range(1, len(header))
+    ]
+    rows = data[:n] + [[other] + totals]
+    return sorted(rows, key=sort_key(1), reverse=True)
+
+
+class Plan(object):
+    """The state of one group-by during a scan."""
+    def __init__(self, header, group_by):
+        index = {column: i for i, column in enumerate(header)}
+        self.group_by = group_by
+        self.groups = dict()
+        self.key = index[group_by.key]
+        self.where = None
+        if group_by.where:
+            column, op, value = group_by.where
+            nocase = op in (EQ_NOCASE, NE_NOCASE)
+            if nocase:
+                value = value.lower()
+            self.where = (index[column], op in (EQ, EQ_NOCASE), value, nocase)
+        self.aggregates = [
+            (
+                aggregate.function,
+                [index[column] for column in aggregate.columns],
+                aggregate.expression,
+            )
+            for aggregate in group_by.aggregates
+        ]
+
+    def add(self, row):
+        if self.where:
+            i, equal, value, nocase = self.where
+            cell = row[i]
+            if nocase and cell is not None:
+                cell = str(cell).lower()
+            if (cell == value) != equal:
+                return
+        key = row[self.key]
+        if self.group_by.expression and key is not None:
+            key = self.group_by.expression(key)
+        values = self.groups.get(key)
+        if values is None:
+            values = self.groups[key] = [
+                0 if function == COUNT else None
+                for function, _, _ in self.aggregates
+            ]
+        for i, (function, columns, expression) in enumerate(self.aggregates):
+            if expression:
+                args = [row[column] for column in columns]
+                value = None if None in args else expression(*args)
+            else:
+                value = row[columns[0]]
+            if value is None:
+                continue
+            if function == COUNT:
+                values[i] += 1
+            elif function == SUM:
+                values[i] = value if values[i] is None else values[i] + value
+            else:
+                values[i] = value
+
+    def result(self):
+        header = self.group_by.header
+        data = [[key] + values for key, values in self.groups.items()]
+        data.sort(
+            key=sort_key(header.index(self.group_by.order_by)),
+            reverse=self.group_by.descending,
+        )
+        return header, data
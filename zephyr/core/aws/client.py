@@ -2,6 +2,8 @@ from ..client import Client
 from ..utils import get_config_values, ZephyrException
 
 class AWSPricingAPI(Client):
+    # Prices are cached once in the database, not per account.
+    cached_by_account = False
     name = "AWS Pricing API"
 
     def __init__(self, config, log=None):
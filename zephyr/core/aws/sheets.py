@@ -14,14 +14,9 @@ class AWSEC2PricingSheet(Sheet):
 
     def load_data(self):
         CD, EC2P = self.clients
-        response = CD.cache_policy(
-            self.account, self.date, self.expire_cache
-        )
-        CD.parse(response)
-        ddh = CD.to_ddh()
+        ddh = CD.load(self.account, self.date, self.expire_cache)
         client_data = [bool(ddh) and bool(ddh.data)]
-        cd_df = pd.DataFrame(ddh.data, columns=ddh.header)
-        cd_df.to_sql(CD.slug, self.con, if_exists='replace')
+        self.registry.to_sql(CD)
         types = list(pd.read_sql(
             """select distinct("InstanceType") from "{}" """.format(CD.slug),
             self.con
@@ -69,14 +64,15 @@ class AWSEC2PricingSheet(Sheet):
         ), self.con)
 
         header = df.columns
-        cu_data = [[
-            self.clean.get(index, lambda x:x)(row[index])
-            for index in range(len(header))
-        ] for row in df.values]
+        cu_data = self.apply_clean(df.values)
         cu_ddh = DDH(data=cu_data, header=list(header))
         self._ddh = cu_ddh
         return self._ddh
 
+    def prefetch_clients(self):
+        """The pricing table is read from the database, not the cache."""
+        return self.clients[:1]
+
     def to_ddh(self):
         if(self._ddh):
             return self._ddh
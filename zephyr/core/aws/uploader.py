@@ -0,0 +1,192 @@
+import fcntl
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+
+from . import utils as aws
+from ..manifest import Manifest
+
+JOURNALS = ".meta/uploads"
+QUEUE_SIZE = 64
+# Attempts at each upload before it is left in the journal for a later run.
+RETRIES = 3
+RETRY_DELAY = 2
+
+_lock = threading.Lock()
+_uploaders = dict()
+
+
+def drain_all():
+    """Wait for the uploads of this process. The CLI calls this at exit."""
+    pid = os.getpid()
+    for (cache_root, owner), uploader in list(_uploaders.items()):
+        if owner == pid:
+            uploader.drain()
+
+
+def get_uploader(cache_root):
+    """Get the uploader of this process. Forked workers get their own."""
+    key = (cache_root, os.getpid())
+    with _lock:
+        if key not in _uploaders:
+            _uploaders[key] = Uploader(cache_root)
+        return _uploaders[key]
+
+
+def in_manifest(cache_root, filename, bucket, key):
+    """A callback which records a finished upload in the manifest."""
+    def uploaded(etag):
+        size = os.path.getsize(filename)
+        Manifest(cache_root).add(bucket, key, size, etag)
+    return uploaded
+
+
+def pending_keys(cache_root):
+    """The keys still waiting for upload in any journal of the cache root."""
+    directory = os.path.join(cache_root, JOURNALS)
+    if not os.path.isdir(directory):
+        return set()
+    return {
+        entry["key"]
+        for filename in os.listdir(directory)
+        if filename.endswith(".journal")
+        for entry in pending(os.path.join(directory, filename))
+    }
+
+
+def pending(path):
+    """Read the uploads in a journal which were never marked done."""
+    entries = dict()
+    with open(path, "r") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            if entry.get("done"):
+                entries.pop(entry["id"], None)
+                continue
+            entries[entry["id"]] = entry
+    return list(entries.values())
+
+
+class Uploader(object):
+    """
+    Upload files to S3 on a background thread so that fetching and rendering
+    do not wait on S3. The queue is bounded, so a slow S3 applies back
+    pressure instead of holding every pending file. Each upload is written
+    to a journal of this process until it is done, and journals left behind
+    by processes which died are replayed by the next uploader. Journals are
+    named uniquely, so a process which reuses the PID of a dead one never
+    takes over its journal.
+    """
+    def __init__(self, cache_root, maxsize=QUEUE_SIZE):
+        self.cache_root = cache_root
+        self.directory = os.path.join(cache_root, JOURNALS)
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, "{pid}-{uid}.journal".format(
+            pid=os.getpid(), uid=uuid.uuid4().hex,
+        ))
+        self.journal = open(self.path, "a")
+        # The lock tells other processes this journal is still in use.
+        fcntl.flock(self.journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.journal_lock = threading.Lock()
+        self.last_id = 0
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.replayed = False
+        self.retry_delay = RETRY_DELAY
+        self.thread = None
+
+    def drain(self):
+        """Block until the queue is empty, then compact the journal."""
+        self.queue.join()
+        with self.journal_lock:
+            if not pending(self.path):
+                self.journal.truncate(0)
+
+    def put(self, s3, filename, bucket, key, log, callback=None):
+        """Queue a file for upload. The callback receives the ETag."""
+        with self.journal_lock:
+            replay, self.replayed = not self.replayed, True
+        if replay:
+            self.replay(s3, log)
+        entry = self.record(dict(filename=filename, bucket=bucket, key=key))
+        self.start()
+        self.queue.put((entry["id"], s3, filename, bucket, key, log, callback))
+
+    def record(self, entry):
+        with self.journal_lock:
+            if "id" not in entry:
+                self.last_id += 1
+                entry["id"] = self.last_id
+            self.journal.write(json.dumps(entry) + "\n")
+            self.journal.flush()
+        return entry
+
+    def replay(self, s3, log):
+        """
+        Queue the pending uploads of every journal which is not this
+        uploader's and which no running process holds.
+        """
+        for filename in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, filename)
+            if path == self.path or not filename.endswith(".journal"):
+                continue
+            with open(path, "a") as journal:
+                try:
+                    fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # Its process is still running.
+                entries = pending(path)
+                for entry in entries:
+                    log.info("Retrying the upload of {}.".format(entry["key"]))
+                    self.put(
+                        s3, entry["filename"], entry["bucket"], entry["key"],
+                        log, callback=in_manifest(
+                            self.cache_root, entry["filename"],
+                            entry["bucket"], entry["key"],
+                        ),
+                    )
+                os.remove(path)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                self.upload(*item)
+            finally:
+                self.queue.task_done()
+
+    def start(self):
+        if self.thread and self.thread.is_alive():
+            return
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def upload(self, upload_id, s3, filename, bucket, key, log, callback):
+        """
+        Upload a file, retrying a few times. An upload which still fails is
+        left in the journal, and the next process to upload replays it.
+        """
+        error = None
+        for attempt in range(RETRIES):
+            if attempt:
+                time.sleep(self.retry_delay * attempt)
+            try:
+                if os.path.isfile(filename):
+                    etag = aws.put_s3(s3, filename, bucket, key)
+                    if not etag:
+                        error = "no ETag was returned"
+                        continue
+                    if callback:
+                        callback(etag)
+                self.record(dict(id=upload_id, done=True))
+                return
+            except Exception as e:
+                error = e
+        log.error(
+            "Upload of {key} failed {n} times and is left for the next run: "
+            "{e}".format(key=key, n=RETRIES, e=error)
+        )
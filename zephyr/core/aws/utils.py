@@ -1,16 +1,50 @@
-import io
+import os
+import threading
 
 import boto3
 
+from boto3.exceptions import RetriesExceededError
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
 from warnings import warn
 
-from botocore.exceptions import ClientError
-from timeout_decorator import timeout, TimeoutError as TimeoutDecoratorError
+from botocore.config import Config
+from botocore.exceptions import (
+    ClientError,
+    ConnectTimeoutError,
+    EndpointConnectionError,
+    ReadTimeoutError,
+)
 
+from .. import cache
 from ..ddh import DDH
 
 
+CONNECT_TIMEOUT = 10
+DELETE_BATCH = 1000  # The most keys delete_objects accepts per request.
+DELETE_WORKERS = 8
+# Enough connections for the prefetch, delete and upload threads at once.
+MAX_POOL_CONNECTIONS = 32
+RETRIES = 3
 TIMEOUT = 30
+# Deadlines are enforced by botocore in process, retrying transient errors.
+S3_CONFIG = Config(
+    connect_timeout=CONNECT_TIMEOUT,
+    max_pool_connections=MAX_POOL_CONNECTIONS,
+    read_timeout=TIMEOUT,
+    retries=dict(max_attempts=RETRIES),
+)
+# Matched with isinstance, so subclasses count too. Transfers which run out
+# of retries on timeouts raise RetriesExceededError.
+TIMEOUT_ERRORS = (
+    ConnectTimeoutError,
+    EndpointConnectionError,
+    ReadTimeoutError,
+    RetriesExceededError,
+)
+
+_s3_clients = dict()
+_s3_lock = threading.Lock()
 
 
 class SilenceExplicitly(object):
@@ -25,7 +59,7 @@ class SilenceExplicitly(object):
             try:
                 return func(*args, **kwargs)
             except Exception as e:
-                if type(e) not in self.errors:
+                if not isinstance(e, tuple(self.errors)):
                     raise e
                 if self.handler is not None:
                     self.handler(e, *args, **kwargs)
@@ -37,6 +71,33 @@ def aws_timeout_warning(exception, *args, **kwargs):
     warn("The call to AWS timed out.")
 
 
+def delete_s3(s3, bucket, keys):
+    """
+    Delete keys in batches of as many as S3 accepts per request, sending the
+    batches concurrently. Return the keys which could not be deleted.
+    """
+    keys = list(keys)
+    batches = [
+        keys[i:i+DELETE_BATCH] for i in range(0, len(keys), DELETE_BATCH)
+    ]
+
+    def delete(batch):
+        response = s3.delete_objects(
+            Bucket=bucket,
+            Delete=dict(
+                Objects=[dict(Key=key) for key in batch],
+                Quiet=True,
+            ),
+        )
+        return [error["Key"] for error in response.get("Errors", [])]
+
+    if not batches:
+        return []
+    workers = min(len(batches), DELETE_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(chain.from_iterable(executor.map(delete, batches)))
+
+
 def get_accounts_aws(key_id, secret):
     sdb = boto3.client(
         'sdb',
@@ -64,19 +125,37 @@ def get_accounts_aws(key_id, secret):
     return DDH(header=header, data=data)
 
 
-@SilenceExplicitly((TimeoutDecoratorError,), handler=aws_timeout_warning)
-@timeout(TIMEOUT, use_signals=False)
-def get_s3(s3, bucket, key):
-    temp = io.BytesIO()
+@SilenceExplicitly(TIMEOUT_ERRORS, retval=False, handler=aws_timeout_warning)
+def get_s3(s3, bucket, key, filename):
+    """
+    Stream an object into a file. Return whether the object was found. The
+    file is only replaced once the download is complete.
+    """
+    temp = cache.temp_path(filename)
     try:
-        s3.meta.client.download_fileobj(
-            bucket,
-            key,
-            temp,
-        )
-    except ClientError as e:
-        pass
-    return temp.getvalue()
+        s3.download_file(bucket, key, temp)
+    except BaseException as e:
+        if os.path.exists(temp):
+            os.remove(temp)
+        if isinstance(e, ClientError):
+            return False
+        raise
+    os.replace(temp, filename)
+    return True
+
+
+def get_s3_client(key_id, secret):
+    """
+    Get the S3 client of this process for a set of credentials. Clients are
+    thread-safe, so every Client shares one and its connection pool. Forked
+    workers build their own since connections cannot cross a fork.
+    """
+    key = (key_id, secret, os.getpid())
+    with _s3_lock:
+        if key not in _s3_clients:
+            session = get_session(key_id, secret)
+            _s3_clients[key] = session.client("s3", config=S3_CONFIG)
+        return _s3_clients[key]
 
 
 def get_session(key_id, secret):
@@ -86,16 +165,25 @@ def get_session(key_id, secret):
     )
 
 
-@SilenceExplicitly((TimeoutDecoratorError,), handler=aws_timeout_warning)
-@timeout(TIMEOUT, use_signals=False)
+def list_s3(s3, bucket, prefix=""):
+    """Yield every object under a prefix, following the pagination."""
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            yield obj
+
+
+@SilenceExplicitly(TIMEOUT_ERRORS, handler=aws_timeout_warning)
 def put_s3(s3, filename, bucket, key):
+    """Stream a file to S3 and return its ETag."""
     with open(filename, "br") as f:
-        s3.meta.client.put_object(
+        response = s3.put_object(
             ACL="bucket-owner-full-control",
             Body=f,
             Bucket=bucket,
             Key=key
         )
+    return response["ETag"]
 
 
 def sdb_flatten(item):
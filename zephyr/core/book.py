@@ -4,10 +4,13 @@ import os
 
 import xlsxwriter
 
+from concurrent.futures import ThreadPoolExecutor
 from shutil import copyfile
 
-from .aws import utils as aws
-from .client import Client
+from .client import Client, Registry
+from .cc.client import CloudCheckrBPC, CloudCheckrBPCs
+
+PREFETCH_WORKERS = 8
 
 FORMATTING = {
     "book_options": {
@@ -36,12 +39,14 @@ class Book(Client):
         self.has_data = False
         self.in_memory = in_memory
         self.label = label
+        self.registry = Registry(config, log=log)
         self.sheets = tuple([Sheet(
             config,
             account=account,
             date=date,
             expire_cache=expire_cache,
-            log=log
+            log=log,
+            registry=self.registry,
         ) for Sheet in sheets])
         self.filename = "{slug}.{label}.xlsx".format(
             label=self.label, slug=self.account
@@ -54,10 +59,9 @@ class Book(Client):
         cache_local = os.path.join(self.ZEPHYR_CACHE_ROOT, cache_key)
         copyfile(self.filename, cache_local)
         # Cache result to local cache and S3
-        self.log.info(cache_local, cache_key)
-        s3 = self.s3  # This is a bit kludgy. TODO: Fix this.
-        if self.ZEPHYR_S3_BUCKET:
-            aws.put_s3(s3, cache_local, self.ZEPHYR_S3_BUCKET, cache_key)
+        self.log.info("Caching {} locally and in S3.".format(cache_key))
+        self.manifest.touch(cache_key)
+        self.put_s3(cache_local, cache_key)
 
     def cache_key(self, slug, account, date):
         month = datetime.datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m")
@@ -77,6 +81,55 @@ class Book(Client):
                 )
         return out
 
+    def missing_validators(self, slug):
+        """Name the clients which do not recognize the given slug."""
+        return ", ".join({
+            validator.name
+            for validator in self.slug_validators()
+            if(not validator.get_account_by_slug(slug))
+        })
+
+    def prefetch(self):
+        """
+        Fetch every response the sheets need at the same time so that a book
+        waits on the slowest backend rather than on the sum of them.
+        """
+        # Sheets which declare the same call share a client from the registry.
+        clients = list({
+            id(client): client
+            for sheet in self.sheets
+            for client in sheet.prefetch_clients()
+        }.values())
+        if not clients:
+            return
+        checks = [
+            client for client in clients
+            if isinstance(client, CloudCheckrBPC)
+        ]
+        others = [client for client in clients if client not in checks]
+        workers = min(len(clients), PREFETCH_WORKERS)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(
+                    client.fetch, self.account, self.date, self.expire_cache
+                )
+                for client in others
+            ]
+            # Best practice checks share one request while the rest fetch.
+            if len(checks) > 1:
+                CloudCheckrBPCs(self.config, log=self.log).fill_checks(
+                    checks, self.account, self.date, self.expire_cache
+                )
+            futures += [
+                executor.submit(
+                    client.fetch, self.account, self.date, self.expire_cache
+                )
+                for client in checks
+            ]
+            # Raise the first error in the calling thread.
+            for future in futures:
+                future.result()
+
     def slug_valid(self, slug):
         return all([
             api.get_account_by_slug(slug)
@@ -95,10 +148,21 @@ class Book(Client):
         }
         return out.values()
 
+    @property
+    def constant_memory(self):
+        value = self.config.get(
+            "zephyr", "ZEPHYR_XLSX_CONSTANT_MEMORY", fallback="0"
+        ) or "0"
+        return value.lower() in ("1", "true", "yes")
+
     def to_xlsx(self):
-        options = FORMATTING["book_options"]
+        options = dict(FORMATTING["book_options"])
         if self.in_memory:
             options.update(dict(in_memory=True))
+        elif self.constant_memory:
+            # Rows are flushed to disk as the sheets move past them.
+            options.update(dict(constant_memory=True))
+        self.prefetch()
         with xlsxwriter.Workbook(self.filename, options) as self.book:
             report = self.collate()
         if(report and not self.in_memory):
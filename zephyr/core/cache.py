@@ -0,0 +1,196 @@
+import fcntl
+import gzip
+import os
+import shutil
+import threading
+
+from contextlib import contextmanager
+
+# Compressed entries are marked by the gzip magic number. Anything else is a
+# plain JSON response written before compression was introduced.
+GZIP_MAGIC = b"\x1f\x8b"
+COMPRESS_LEVEL = 6
+EXTENSIONS = (".json",)
+# Work in progress next to an entry, never evicted or uploaded.
+SCRATCH = (".lock", ".partial", ".tmp")
+
+
+class Stored(object):
+    """
+    A response read from its file a line at a time, compressed or not,
+    rather than held as one string. Each iteration reads the file again.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def __iter__(self):
+        with open(self.path, "rb") as f:
+            head = f.read(len(GZIP_MAGIC))
+            f.seek(0)
+            lines = gzip.GzipFile(fileobj=f) if is_compressed(head) else f
+            for line in lines:
+                yield line.decode("utf-8")
+
+    def read(self):
+        return read(self.path)
+
+
+def compress(blob):
+    return gzip.compress(blob, compresslevel=COMPRESS_LEVEL)
+
+
+def compress_file(path):
+    """Compress a cache entry in place. Return False if it already was."""
+    with open(path, "rb") as f:
+        blob = f.read()
+    if is_compressed(blob):
+        return False
+    replace(path, compress(blob))
+    return True
+
+
+def decode(blob):
+    """Decode a cache entry, compressed or not, into a response string."""
+    if is_compressed(blob):
+        blob = gzip.decompress(blob)
+    return blob.decode("utf-8")
+
+
+def encode(response):
+    return compress(response.encode("utf-8"))
+
+
+def evict(cache_root, limit, accessed, pinned):
+    """
+    Delete the least recently used files until the cache root fits in limit
+    bytes. Files are ranked by the later of their recorded access and their
+    modification time. Keys for which pinned returns True are never deleted,
+    nor are entries locked by a fetch. Lock files are left in place, since
+    another process may be waiting on them. Return the keys of the deleted
+    files.
+    """
+    total = 0
+    candidates = list()
+    for root, dirs, files in os.walk(cache_root):
+        for filename in files:
+            path = os.path.join(root, filename)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            total += stat.st_size
+            key = os.path.relpath(path, cache_root)
+            if filename.endswith(SCRATCH) or pinned(key):
+                continue
+            used = max(accessed.get(key, 0), stat.st_mtime)
+            candidates.append((used, stat.st_size, key))
+    evicted = list()
+    for used, size, key in sorted(candidates):
+        if total <= limit:
+            break
+        path = os.path.join(cache_root, key)
+        with try_lock(path) as locked:
+            if not locked:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+        total -= size
+        evicted.append(key)
+    return evicted
+
+
+def entries(cache_root):
+    """Walk the cache root yielding the path of each cached response."""
+    for root, dirs, files in os.walk(cache_root):
+        for filename in sorted(files):
+            if filename.endswith(EXTENSIONS):
+                yield os.path.join(root, filename)
+
+
+@contextmanager
+def lock(path):
+    """
+    Hold an exclusive lock on a cache entry across threads and processes so
+    that only one of them fetches it while the others wait to reuse it.
+    """
+    with open("{}.lock".format(path), "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def is_compressed(blob):
+    return blob[:len(GZIP_MAGIC)] == GZIP_MAGIC
+
+
+def mtime(path):
+    """The modification time of an entry, or None if it does not exist."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def partial_path(path):
+    """A file next to an entry where a response is written as it arrives."""
+    return "{}.partial".format(path)
+
+
+def read(path):
+    with open(path, "rb") as f:
+        return decode(f.read())
+
+
+def replace(path, blob):
+    """Write through a temporary file so readers never see a partial entry."""
+    temp = temp_path(path)
+    try:
+        with open(temp, "wb") as f:
+            f.write(blob)
+        os.replace(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
+
+
+def temp_path(path):
+    """A name next to an entry which is unique to this process and thread."""
+    return "{path}.{pid}.{thread}.tmp".format(
+        path=path, pid=os.getpid(), thread=threading.get_ident()
+    )
+
+
+@contextmanager
+def try_lock(path):
+    """Lock an entry as lock does, but yield False at once if it is held."""
+    with open("{}.lock".format(path), "a") as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write(path, response):
+    replace(path, encode(response))
+
+
+def write_file(path, source):
+    """Compress a file into an entry without holding it in memory."""
+    temp = temp_path(path)
+    try:
+        with open(source, "rb") as f_in:
+            with gzip.open(temp, "wb", compresslevel=COMPRESS_LEVEL) as f_out:
+                shutil.copyfileobj(f_in, f_out)
+        os.replace(temp, path)
+    except BaseException:
+        os.remove(temp)
+        raise
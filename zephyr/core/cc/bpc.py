@@ -0,0 +1,84 @@
+import re
+
+from decimal import Decimal, InvalidOperation
+
+from ..schema import DECIMAL, INTEGER, MONEY, PERCENT, TEXT
+
+# "i-0123abcd (name)" holds an instance ID and, optionally, its name.
+INSTANCE = re.compile(r"\s*(\S*)[^(]*(?:\((.*?)\))?")
+FIELD_SEP = " | "
+PAIR_SEP = ": "
+SYMBOLS = str.maketrans("", "", "$,%")
+
+_parsers = dict()
+
+
+# Values which are not numbers, such as "N/A", become None (NULL) so that
+# sums and sorts skip them as SQL would.
+def to_decimal(value):
+    try:
+        return Decimal(value.translate(SYMBOLS))
+    except InvalidOperation:
+        return None
+
+
+def to_integer(value):
+    try:
+        return int(value.translate(SYMBOLS))
+    except ValueError:
+        return None
+
+
+CONVERTERS = {
+    DECIMAL: to_decimal,
+    INTEGER: to_integer,
+    MONEY: to_decimal,
+    PERCENT: to_decimal,
+    TEXT: str,
+}
+
+
+def get_parser(bpc_id, header, types):
+    """Get the parser of a check, compiling it the first time."""
+    if bpc_id not in _parsers:
+        _parsers[bpc_id] = Parser(header, types)
+    return _parsers[bpc_id]
+
+
+def parse_instance(value):
+    """Split an instance into its ID and its name, or "" if it has none."""
+    instance_id, name = INSTANCE.match(value).groups()
+    return instance_id, name or ""
+
+
+class Parser(object):
+    """
+    Parse the result strings of a best practice check, such as
+    "Instance: i-0123abcd (name) | Predicted Monthly Cost: $1,024.00",
+    into rows of the given header. Money, percent and numeric columns are
+    converted to Decimal or int as each row is built, so sheets receive
+    values that are ready for aggregation. Those which are not numbers are
+    None.
+    """
+    def __init__(self, header, types):
+        self.header = tuple(header)
+        self.columns = tuple(
+            (column, CONVERTERS[types.get(column, TEXT)])
+            for column in self.header
+        )
+        self.instance = bool(
+            {"Instance ID", "Instance Name"} & set(self.header)
+        )
+
+    def row(self, item):
+        fields = dict(
+            pair.split(PAIR_SEP, 1) for pair in item.split(FIELD_SEP)
+        )
+        if self.instance and "Instance" in fields:
+            fields["Instance ID"], fields["Instance Name"] = parse_instance(
+                fields["Instance"]
+            )
+        return [convert(fields[column]) for column, convert in self.columns]
+
+    def rows(self, items):
+        return [self.row(item) for item in items]
@@ -1,16 +1,40 @@
 import csv
+import hashlib
 import json
 
 import pandas as pd
-import requests
 
+from collections import OrderedDict
 from datetime import datetime
 from itertools import groupby
 from urllib.parse import urlencode
 
+from .. import cache, schema, sessions
 from ..ddh import DDH
-from ..utils import timed
-from . import client as cc
+from ..utils import (
+    first_of_previous_month,
+    from_isoformat,
+    timed,
+    ZephyrException,
+)
+from . import bpc, client as cc
+
+def to_datetime(value):
+    """Parse an ISO 8601 time, or leave a value which is not one as it is."""
+    try:
+        return from_isoformat(value)
+    except (TypeError, ValueError):
+        return value
+
+def digest(response):
+    """The digest of a cached response, which deltas name their base by."""
+    sha = hashlib.sha256()
+    for line in cc.lines(response):
+        sha.update(line.encode())
+    return sha.hexdigest()
+
+class StaleDelta(ZephyrException):
+    """The base a delta was stored against is gone or has been replaced."""
 
 class CloudCheckrAccounts(cc.CloudCheckr):
     uri = "account.json/get_accounts_v2"
@@ -24,7 +48,12 @@ class CloudCheckrAccounts(cc.CloudCheckr):
             urlencode(params),
         ])
         self.log.debug(url)
-        r = timed(lambda:requests.get(url), log=self.log.info)()
+        r = timed(
+            lambda:sessions.get(
+                self.session, url, log=self.log.info, limiter=self.limiter
+            ),
+            log=self.log.info
+        )()
         accts = r.json()
         header = ["aws_account", "id", "name"]
         data = [[
@@ -53,32 +82,230 @@ class ComputeDetails(cc.CloudCheckr):
             "Environment",
             "Status",
         )
+    fields = header + ("ResourceTags",)
+    types = {
+        "Environment": schema.TEXT,
+        "InstanceId": schema.TEXT,
+        "InstanceName": schema.TEXT,
+        "InstanceType": schema.TEXT,
+        "LaunchTime": schema.TIMESTAMP,
+        "PricingPlatform": schema.TEXT,
+        "PrivateIpAddress": schema.TEXT,
+        "Region": schema.TEXT,
+        "ResourceTags": schema.JSON,
+        "Status": schema.TEXT,
+        "Tenancy": schema.TEXT,
+    }
+
+    # Deltas are stored against the previous month's entry. Reading one
+    # reads its whole chain of bases, so the chain is kept short.
+    delta_depth = 6
 
     def __init__(self, config=None, log=None, **kwargs):
         if(config):
             super().__init__(config=config, log=log, **kwargs)
         self.all_tags = kwargs.get("all_tags")
+        self.delta = None
+
+    @classmethod
+    def base_date(cls, date):
+        return first_of_previous_month(
+            datetime.strptime(date, "%Y-%m-%d")
+        ).strftime("%Y-%m-%d")
+
+    @staticmethod
+    def get_delta(response):
+        """The delta a response is stored as, or None for full pages."""
+        first = next(
+            (line for line in cc.lines(response) if line.strip()), ""
+        )
+        if not first.lstrip().startswith('{"Delta"'):
+            return None
+        return json.loads(first)["Delta"]
+
+    @property
+    def deltas_enabled(self):
+        value = self.config.get(
+            "zephyr", "ZEPHYR_CACHE_DELTAS", fallback="0"
+        ) or "0"
+        return value.lower() in ("1", "true", "yes")
+
+    def churn(self, account, date):
+        """
+        The IDs of the instances added, removed and changed since the
+        previous month. Deltas store these, so reading them is cheap.
+        """
+        response = self.read_cached(account, date)
+        if response is None:
+            response = self.cache_policy(account, date, False)
+        delta = self.get_delta(response)
+        if delta is None:
+            base = self.instances_for(account, self.base_date(date))
+            if base is None:
+                raise ZephyrException(
+                    "No cached inventory for {} to compare against."
+                    .format(self.base_date(date))
+                )
+            delta = self.diff(base, self.instances(response))
+        return dict(
+            added={item["InstanceId"] for item in delta["added"]},
+            removed=set(delta["removed"]),
+            changed={item["InstanceId"] for item in delta["changed"]},
+        )
+
+    @classmethod
+    def compared(cls, item):
+        """
+        The part of an instance which parse reads: its header fields and its
+        tags in any order. Metrics and the like change every month.
+        """
+        tags = sorted(
+            (tag.get("Key"), tag.get("Value"))
+            for tag in item.get("ResourceTags") or []
+        )
+        return [item.get(field) for field in cls.header] + [tags]
+
+    def diff(self, base, current):
+        """The delta between two maps of instances by ID."""
+        return dict(
+            added=[
+                item for key, item in current.items() if key not in base
+            ],
+            removed=[key for key in base if key not in current],
+            changed=[
+                item for key, item in current.items()
+                if key in base
+                and self.compared(base[key]) != self.compared(item)
+            ],
+        )
+
+    def instances(self, response, project=None):
+        """
+        Map the instances of a response, full or delta, by their ID. A
+        projection, such as project, applies to the items of every month.
+        """
+        project = project or (lambda item: item)
+        delta = self.get_delta(response)
+        if delta is None:
+            return OrderedDict(
+                (item["InstanceId"], project(item))
+                for item in self.merge(self.get_pages(response))
+            )
+        self.delta = delta
+        out = self.instances_for(
+            delta["account"], delta["base_date"], project,
+            delta.get("base_digest"),
+        )
+        if out is None:
+            raise StaleDelta(
+                "The base of {} for {} is no longer cached. "
+                "Refresh it with --expire-cache."
+                .format(self.slug, delta["base_date"])
+            )
+        for key in delta["removed"]:
+            out.pop(key, None)
+        for item in delta["changed"] + delta["added"]:
+            out[item["InstanceId"]] = project(item)
+        return out
+
+    def instances_for(self, account, date, project=None, expected=None):
+        """
+        The instances cached for a month, or None if not cached. With an
+        expected digest, the entry is the base of a delta and must match it.
+        """
+        base = type(self)(config=self.config, log=self.log)
+        response = base.read_cached(account, date)
+        if response is None:
+            return None
+        if expected is not None and digest(response) != expected:
+            raise StaleDelta(
+                "The base of {} for {} has changed since it was cached. "
+                "Refresh it with --expire-cache."
+                .format(self.slug, date)
+            )
+        return base.instances(response, project)
+
+    def load(self, account, date, expired):
+        """Fetch and parse a response, refetching a delta whose base is gone."""
+        try:
+            return super().load(account, date, expired)
+        except StaleDelta as e:
+            if expired:
+                raise
+            self.log.warning("{} Fetching it again.".format(e))
+            self.delta = self.response = None
+            return super().load(account, date, True)
 
     def parse(self, json_string):
-        results = json.loads(json_string)
-        items = self.merge(results)
+        items = self.instances(json_string, self.project).values()
         if self.all_tags:
             self.header = self.header[:-2] + ("ResourceTags",) + self.header[-2:]
 
-        data = list()
-        for row in items:
-            filtered = self._filter_row(row)
-            data.append([filtered.get(col, "") for col in self.header])
-        self.data = data
+        self.data = [[item.get(col, "") for col in self.header] for item in items]
+        index = self.header.index("LaunchTime")
+        for row in self.data:
+            row[index] = to_datetime(row[index])
 
-    def _filter_row(self, row):
-        if "ResourceTags" not in row:
-            return row
-        for tag in row["ResourceTags"]:
+    def project(self, item):
+        """Keep the header fields and the environment tag of an instance."""
+        item = super().project(item)
+        if "ResourceTags" not in item:
+            return item
+        for tag in item["ResourceTags"]:
             if tag["Key"] != "lw:environment":
                 continue
-            row["Environment"] = tag["Value"]
-        return row
+            item["Environment"] = tag["Value"]
+        if not self.all_tags:
+            del item["ResourceTags"]
+        return item
+
+    def write_entry(self, account, date, cache_local, partial, response):
+        """
+        Store only what changed since the previous month when deltas are
+        enabled and the previous month is cached, otherwise the full pages.
+        """
+        delta = None
+        if self.deltas_enabled:
+            delta = self.make_delta(account, date, response)
+        if delta is None:
+            return super().write_entry(
+                account, date, cache_local, partial, response
+            )
+        self.log.info(
+            "Storing {call} as {added} added, {removed} removed and "
+            "{changed} changed instances.".format(
+                call=self.slug,
+                added=len(delta["added"]),
+                removed=len(delta["removed"]),
+                changed=len(delta["changed"]),
+            )
+        )
+        cache.write(cache_local, json.dumps(dict(Delta=delta)))
+
+    def make_delta(self, account, date, response):
+        base_date = self.base_date(date)
+        base = type(self)(config=self.config, log=self.log)
+        base_response = base.read_cached(account, base_date)
+        if base_response is None:
+            return None
+        base_delta = self.get_delta(base_response)
+        depth = 1 + (base_delta["depth"] if base_delta else 0)
+        if depth > self.delta_depth:
+            return None
+        try:
+            base_instances = base.instances(base_response)
+        except StaleDelta:
+            return None
+        current = self.instances(response)
+        delta = self.diff(base_instances, current)
+        # A delta which carries most of the inventory saves nothing.
+        if 2 * (len(delta["added"]) + len(delta["changed"])) > len(current):
+            return None
+        delta.update(
+            account=account, base_date=base_date, depth=depth,
+            base_digest=digest(base_response),
+        )
+        return delta
 
     def _items_from_pages(self, page):
         return page["Ec2Instances"]
@@ -100,6 +327,13 @@ class ComputeMigration(cc.CloudCheckrBPC):
             "Memory for current",
             "Memory for next gen",
         )
+    types = {
+        "On-Demand Current Monthly Cost": bpc.MONEY,
+        "Cost for Recommended": bpc.MONEY,
+        "Yearly Savings": bpc.MONEY,
+        "vCPU for current": bpc.INTEGER,
+        "vCPU for next gen": bpc.INTEGER,
+    }
 
 class ComputeRI(cc.CloudCheckrBPC):
     bpc_id = 190
@@ -116,6 +350,13 @@ class ComputeRI(cc.CloudCheckrBPC):
             "On-Demand Monthly Cost",
             "Total Savings",
         )
+    types = {
+        "Number": bpc.INTEGER,
+        "Upfront RI Cost": bpc.MONEY,
+        "Reserved Monthly Cost": bpc.MONEY,
+        "On-Demand Monthly Cost": bpc.MONEY,
+        "Total Savings": bpc.MONEY,
+    }
 
 class ComputeUnderutilized(cc.CloudCheckrBPC):
     bpc_id = 68
@@ -127,6 +368,10 @@ class ComputeUnderutilized(cc.CloudCheckrBPC):
             "Predicted Monthly Cost",
             "Region",
         )
+    types = {
+        "Average CPU Util": bpc.PERCENT,
+        "Predicted Monthly Cost": bpc.MONEY,
+    }
 
 class DBDetails(cc.CloudCheckr):
     slug = "db-details"
@@ -145,6 +390,13 @@ class DBDetails(cc.CloudCheckr):
         "Endpoint",
         "BackupRetentionPeriod",
     )
+    fields = header
+    types = {
+        "AllocatedStorageGB": schema.INTEGER,
+        "BackupRetentionPeriod": schema.INTEGER,
+        "FreeStorageSpaceBytes": schema.REAL,
+        "MonthlyCost": schema.REAL,
+    }
 
     def _items_from_pages(self, page):
         return page["RdsDbInstances"]
@@ -159,6 +411,11 @@ class DBIdle(cc.CloudCheckrBPC):
         "Predicted Monthly Cost",
         "Region",
     )
+    types = {
+        "Average Read IOPS": bpc.DECIMAL,
+        "Average Write IOPS": bpc.DECIMAL,
+        "Predicted Monthly Cost": bpc.MONEY,
+    }
 
 class IAMUsersData(cc.CloudCheckr):
     slug = "iam-users"
@@ -172,7 +429,7 @@ class IAMUsersData(cc.CloudCheckr):
     )
 
     def parse(self, json_string):
-        results = json.loads(json_string)
+        results = self.get_pages(json_string)
         items = self.merge(results)
         self.data = [
             [
@@ -197,6 +454,10 @@ class LBIdle(cc.CloudCheckrBPC):
         "Average Hourly Request Count",
         "Predicted Monthly Cost",
     )
+    types = {
+        "Average Hourly Request Count": bpc.DECIMAL,
+        "Predicted Monthly Cost": bpc.MONEY,
+    }
 
 class StorageDetached(cc.CloudCheckrBPC):
     bpc_id = 1
@@ -208,6 +469,9 @@ class StorageDetached(cc.CloudCheckrBPC):
         "EC2 Instance",
         "Region",
     )
+    types = {
+        "Predicted Monthly Cost": bpc.MONEY,
+    }
 
 
 __ALL__ = [
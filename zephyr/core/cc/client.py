@@ -1,16 +1,33 @@
+import io
 import json
+import os
+import time
 
-import pandas as pd
 import requests
 
+from contextlib import ExitStack
+from itertools import chain
 from urllib.parse import urlencode
-from re import search, sub
 
+from .. import cache, sessions
+from . import bpc
 from ..client import Client
 from ..utils import get_config_values, timed, ZephyrException
 
+# Tokens of an interrupted fetch are only resumed while they are fresh.
+PARTIAL_TTL = 3600
+
+def lines(response):
+    """The lines of a response, whether a string or stored in a file."""
+    if isinstance(response, str):
+        return io.StringIO(response)
+    return response
+
 class CloudCheckr(Client):
     name = "CloudCheckr"
+    # The item fields parse reads. Items keep only these once their page is
+    # read; None keeps every field.
+    fields = None
 
     @classmethod
     def get_params(cls, cc_api_key, name, date):
@@ -35,44 +52,86 @@ class CloudCheckr(Client):
         self.CC_API_BASE = CC_API_BASE
         return self._CC_API_KEY
 
+    @property
+    def limiter(self):
+        return sessions.get_limiter(self.name)
+
+    @property
+    def session(self):
+        return sessions.get_session(self.name)
+
     def get_account_by_slug(self, acc_short_name):
-        matches = pd.read_sql("""
-            SELECT a.name AS slug, c.name AS cc_name
-            FROM
-                sf_aws AS a LEFT OUTER JOIN
-                cc_accounts AS c ON (c.aws_account = a."Acct_Number__c")
-            WHERE a.name = '{slug}'
-            """.format(slug=acc_short_name),
-            self.database
-        )["cc_name"]
-
-        if not len(matches):
+        account = self.get_account(acc_short_name)
+        if account is None:
             raise ZephyrException(
                 "No matching account for {}. "
                 "Please see zephyr meta for a list of accounts."
                 .format(acc_short_name)
             )
-
-        return matches[0]
+        return account.cc_name
 
     def get_instance_id(self, instance_string):
-        return instance_string.strip().split(" ")[0]
+        return bpc.parse_instance(instance_string)[0]
 
     def get_instance_name(self, instance_string):
-        regex = search("\((.*?)\)", instance_string)
-        if regex is not None:
-            return search("\((.*?)\)", instance_string).group(0)[1:-1]
-        return ""
+        return bpc.parse_instance(instance_string)[1]
+
+    def fill(self, account, date, cache_key):
+        """
+        Stream pages to a partial file as they arrive, resuming a fetch that
+        was interrupted, and cache them once the last page is stored.
+        """
+        cache_local = os.path.join(self.ZEPHYR_CACHE_ROOT, cache_key)
+        partial = cache.partial_path(cache_local)
+        url = self.get_url(account, date)
+        self.log.debug(url)
+        self.store_pages(url, partial, timing=True, log=self.log.info)
+        self.log.info("Caching {api} response for {call} locally.".format(
+            api=self.name,
+            call=self.slug,
+        ))
+        self.write_entry(
+            account, date, cache_local, partial, cache.Stored(partial)
+        )
+        os.remove(partial)
+        self.cached(cache_key)
+        return self.read_entry(cache_local)
+
+    def get_pages(self, response):
+        """
+        Decode the pages of a response one at a time. Responses are stored
+        one page per line, or as a JSON list of pages by older versions.
+        """
+        response_lines = iter(lines(response))
+        for line in response_lines:
+            if not line.strip():
+                continue
+            if line.lstrip().startswith("["):
+                yield from json.loads(line + "".join(response_lines))
+                return
+            yield json.loads(line)
 
-    def load_pages(self, url, timing=False, log=print):
+    def read_entry(self, path):
+        """Read pages from the cache entry as they are parsed."""
+        return cache.Stored(path)
+
+    def get_url(self, account, date):
+        cc_name = self.get_account_by_slug(account)
+        params = self.get_params(self.CC_API_KEY, cc_name, date)
+        return "".join([
+            self.CC_API_BASE,
+            self.uri,
+            "?",
+            urlencode(params),
+        ])
+
+    def iter_pages(self, url, token="", timing=False, log=print):
         """
         Pagination
         """
         tmpl = "&next_token={token}"
-        token = ""
         page_next = True
-        out = list()
-        def time(func):
+        def timer(func):
             if(timing):
                 return timed(func, log=log)
             return func
@@ -81,7 +140,9 @@ class CloudCheckr(Client):
             url_cur = url
             if(token):
                 url_cur = url + tmpl.format(token=token)
-            resp = time(lambda:requests.get(url_cur))()
+            resp = timer(lambda:sessions.get(
+                self.session, url_cur, log=log, limiter=self.limiter
+            ))()
             if(resp.status_code != 200):
                 raise ZephyrException(
                     "Response not OK, got code: {}".format(resp.status_code)
@@ -91,34 +152,85 @@ class CloudCheckr(Client):
             token = ""
             if(page_next):
                 token = obj["NextToken"]
-            out.append(obj)
-        return out
+            yield obj
+
+    def resume(self, path, log=print):
+        """
+        Find where the pages in a partial file leave off. Return the token
+        of the next page and whether any pages remain. A line cut short by
+        an interruption is dropped.
+        """
+        if(
+            not os.path.isfile(path)
+            or time.time() - os.path.getmtime(path) > PARTIAL_TTL
+        ):
+            open(path, "w").close()
+            return "", True
+        last = None
+        size = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    last = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    break
+                size += len(line)
+        with open(path, "ab") as f:
+            f.truncate(size)
+        if last is None:
+            return "", True
+        if not last.get("HasNext", False):
+            return "", False
+        log("Resuming {call} from a stored page.".format(call=self.slug))
+        return last["NextToken"], True
+
+    def store_pages(self, url, path, timing=False, log=print):
+        """Append each page to a file as it arrives, one page per line."""
+        token, page_next = self.resume(path, log=log)
+        if not page_next:
+            return
+        with open(path, "a") as f:
+            for page in self.iter_pages(url, token, timing=timing, log=log):
+                f.write(json.dumps(page) + "\n")
+                f.flush()
+
+    def project(self, item):
+        """
+        Keep only the fields that parse reads of an item. This is not done
+        while decoding: each page is decoded whole, then its items are
+        projected as merge yields them, so the unused fields of at most a
+        page of items are held at a time.
+        """
+        return {field: item[field] for field in self.fields if field in item}
 
     def merge(self, pages):
-        return sum([
-            self._items_from_pages(page)
-            for page in pages
-        ], [])
+        """Chain the items of each page, holding one page at a time."""
+        return chain.from_iterable(
+            self._items_from_pages(page) for page in pages
+        )
 
     def parse(self, json_string):
-        results = json.loads(json_string)
+        results = self.get_pages(json_string)
         items = self.merge(results)
+        if self.fields:
+            items = map(self.project, items)
         self.data = [[row[col] for col in self.header] for row in items]
 
     def request(self, account, date):
-        cc_name = self.get_account_by_slug(account)
-        params = self.get_params(self.CC_API_KEY, cc_name, date)
-        url = "".join([
-            self.CC_API_BASE,
-            self.uri,
-            "?",
-            urlencode(params),
-        ])
+        url = self.get_url(account, date)
         self.log.debug(url)
-        response = self.load_pages(url, timing=True, log=self.log.info)
-        return json.dumps(response)
+        pages = self.iter_pages(url, timing=True, log=self.log.info)
+        return "\n".join(json.dumps(page) for page in pages)
+
+    def write_entry(self, account, date, cache_local, partial, response):
+        """Compress the stored pages into the cache entry."""
+        cache.write_file(cache_local, partial)
 
 class CloudCheckrBPC(CloudCheckr):
+    bpc_id = None
+    types = dict()
     uri = "best_practice.json/get_best_practices"
 
     @classmethod
@@ -133,25 +245,88 @@ class CloudCheckrBPC(CloudCheckr):
     def __init__(self, bpc_id=None, config=None, log=None, **kwargs):
         if(config):
             super().__init__(config, log=log)
-        self.bpc_id = bpc_id
+        self.bpc_id = bpc_id or self.bpc_id
+
+    @property
+    def parser(self):
+        return bpc.get_parser(self.bpc_id, self.header, self.types)
 
     def parse(self, json_string):
-        results = json.loads(json_string)
-        items = self.merge(results)
-        self.data = [
-            self.row(item)
-            for item in items
-        ]
+        results = self.get_pages(json_string)
+        self.data = self.parser.rows(self.merge(results))
 
     def row(self, item):
-        row = dict([pair.split(": ") for pair in item.split(" | ")])
-        if "Instance" in row.keys():
-            row["Instance ID"] = self.get_instance_id(row["Instance"])
-            row["Instance Name"] = self.get_instance_name(row["Instance"])
-        return [row[key] for key in self.header]
+        return self.parser.row(item)
 
     def _items_from_pages(self, page):
         result = page["BestPracticeChecks"]
         if result:
             return result[0]['Results']
         return []
+
+
+class CloudCheckrBPCs(CloudCheckr):
+    """
+    Fetch several best practice checks of an account in one paginated pass
+    instead of one pass per check, then cache the results of each check as
+    if its own call had fetched them. Checks the combined response leaves
+    out are fetched on their own by their clients as usual.
+    """
+    slug = "best-practices"
+    uri = CloudCheckrBPC.uri
+
+    def fill_checks(self, clients, account, date, expired=False):
+        """Cache the responses of BPC clients. Return the clients filled."""
+        pending = [
+            client for client in clients
+            if expired or not client.is_cached(account, date)
+        ]
+        if len(pending) < 2:
+            return []
+        paths = sorted({
+            os.path.join(self.ZEPHYR_CACHE_ROOT, client.cache_key(account, date))
+            for client in pending
+        })
+        with ExitStack() as stack:
+            for path in paths:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                stack.enter_context(cache.lock(path))
+            if not expired:
+                # Another process may have filled some while we waited.
+                pending = [
+                    client for client in pending
+                    if not client.is_cached(account, date)
+                ]
+                if len(pending) < 2:
+                    return []
+            try:
+                pages = self.partition(account, date, pending)
+            except (requests.RequestException, ValueError, ZephyrException) as e:
+                self.log.warning(
+                    "Fetching best practice checks one at a time: {}".format(e)
+                )
+                return []
+            filled = list()
+            for client in pending:
+                if not pages[client.bpc_id]:
+                    continue
+                response = "\n".join(
+                    json.dumps(page) for page in pages[client.bpc_id]
+                )
+                client.cache(response, client.cache_key(account, date))
+                client.response = response
+                filled.append(client)
+        return filled
+
+    def partition(self, account, date, clients):
+        """Split each page of all checks into pages for each wanted check."""
+        pages = {client.bpc_id: list() for client in clients}
+        url = self.get_url(account, date)
+        self.log.debug(url)
+        for page in self.iter_pages(url, timing=True, log=self.log.info):
+            for check in page.get("BestPracticeChecks") or []:
+                if check.get("CheckId") in pages:
+                    pages[check["CheckId"]].append(
+                        dict(page, BestPracticeChecks=[check])
+                    )
+        return pages
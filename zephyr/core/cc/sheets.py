@@ -1,10 +1,8 @@
 import pandas as pd
-import sqlite3
 
-from decimal import Decimal
-from operator import itemgetter
 from datetime import datetime
 
+from .. import aggregate
 from ..ddh import DDH
 from ..sheet import Sheet
 from .calls import (
@@ -19,25 +17,41 @@ from .calls import (
     StorageDetached,
 )
 
-def clean_money(value):
-    return value.replace(",", "").replace("$", "")
+RUNNING = ("Status", aggregate.EQ, "running")
+
+
+def annual_cost(monthly):
+    return float(monthly) * 12
+
+
+def annual_ri_cost(monthly, upfront):
+    return float(monthly) * 12 + float(upfront)
+
+
+def environment_label(environment):
+    return environment or "No environment"
+
+
+def count_instances(column):
+    """Count running instances by a column, or every instance by status."""
+    if column == "Status":
+        return aggregate.count_by(column)
+    return aggregate.count_by(column, where=RUNNING)
 
-def clean_percent(value):
-    return value.replace("%", "")
 
 class SheetDBIdle(Sheet):
     name = "DB Idle"
     title = "Idle DB Instances"
     calls = (DBIdle,)
-    clean = {
-        3 : clean_money,
-    }
 
 
 class SheetComputeDetails(Sheet):
     name = "EC2s"
     title = "EC2 Details"
     calls = (ComputeDetails,)
+    group_bys = tuple(map(count_instances, (
+        "Region", "PricingPlatform", "Status", "InstanceType"
+    )))
 
     def to_xlsx(self, book, **kwargs):
         """Format the sheet and insert the data for the EC2 sheet."""
@@ -47,13 +61,6 @@ class SheetComputeDetails(Sheet):
 
         self.book = book
 
-        #Format datetimes
-        index = self.ddh.header.index("LaunchTime")
-        for row in self.ddh.data:
-            row[index] = datetime.strptime(
-                row[index], "%Y-%m-%dT%H:%M:%S"
-            ).strftime("%m/%d/%y %H:%M")
-
         # Insert raw data.
         self.sheet = self.book.add_worksheet(self.title)
         self.put_label(self.title)
@@ -92,26 +99,7 @@ class SheetComputeDetails(Sheet):
 
     def count_by(self, column):
         """Count rows in data grouping by values in the column specified"""
-        con = sqlite3.connect(":memory:")
-        df = pd.DataFrame(self.ddh.data, columns=self.ddh.header)
-        df.to_sql("df", con, if_exists="replace")
-        where = ""
-        if column != "Status":
-            where = """WHERE "Status" = 'running' """
-        query = """
-            SELECT
-                 {col},
-                 COUNT({col}) as Total
-             FROM df
-             {where}
-             GROUP BY {col}
-             ORDER BY COUNT({col}) DESC
-        """.format(col=column, where=where)
-        sql_group = pd.read_sql(query, con)
-        header = list(sql_group)
-        data = [list(row) for row in sql_group.values]
-
-        return header, data
+        return self.aggregate(count_instances(column))
 
     def count_by_column_chart(
         self, column_name, top, left, name
@@ -119,17 +107,9 @@ class SheetComputeDetails(Sheet):
         """Insert a column chart with data specified."""
         table_top = top + 1  # Account for label.
 
-        # Get first 4 data rows
+        # Keep the first 4 rows and roll the rest up into "Other".
         header, data_ = self.count_by(column_name)
-        data = data_[:4]
-
-        # Rollup remaining values into "other" column
-        other_values = [item[1] for item in data_[4:]]
-        other_row = ["Other", sum(other_values)]
-
-        # Append data
-        data.append(other_row)
-        data = sorted(data, key=itemgetter(1), reverse=True)
+        data = aggregate.top(header, data_, 4)
         counts = DDH(header=header, data=data)
 
         self.put_label(column_name, top, self.table_left)
@@ -191,26 +171,29 @@ class SheetComputeDetails(Sheet):
         return self.book
 
     def get_launch_times(self):
-        launch_times = []
+        """
+        The launch times of running instances, bucketed by age in days.
+        Instances without a launch time, such as "", are left out.
+        """
         status_index = self.ddh.header.index("Status")
         lt_index = self.ddh.header.index("LaunchTime")
-        for row in self.ddh.data:
-            if row[status_index] != "running":  # Only include running instances
-                continue
-            launch_times.append(row[lt_index])
+        launch_times = [
+            row[lt_index] for row in self.ddh.data
+            if row[status_index] == "running"
+            and isinstance(row[lt_index], datetime)
+        ]
 
         now = datetime.strptime(self.date, "%Y-%m-%d").date()
         days_90 = 0
         days_180 = 0
         days_270 = 0
-        for date in launch_times:
-            day = datetime.strptime(date, "%m/%d/%y %H:%M").date()
-            delta = now - day
-            if 90 < delta.days <= 180:
+        for launch_time in launch_times:
+            days = (now - launch_time.date()).days
+            if 90 < days <= 180:
                 days_90 += 1
-            if 180 < delta.days <= 270:
+            elif 180 < days <= 270:
                 days_180 += 1
-            if delta.days > 270:
+            elif days > 270:
                 days_270 += 1
 
         return launch_times, days_90, days_180, days_270
@@ -226,20 +209,12 @@ class SheetLBIdle(Sheet):
     name = "LB Idle"
     title = "Idle LBs"
     calls = (LBIdle,)
-    clean = {
-        2 : clean_money,
-    }
 
 
 class SheetComputeMigration(Sheet):
     name = "Migration"
     title = "EC2 Migration Recommendations"
     calls = (ComputeMigration,)
-    clean = {
-        4 : clean_money,
-        5 : clean_money,
-        6 : clean_money,
-    }
 
 
 class SheetDBDetails(Sheet):
@@ -277,24 +252,10 @@ class SheetDBDetails(Sheet):
 
     def sum_and_count_by(self, column_name, cost_column):
         """Count and sum rows in data grouping by values in the given column."""
-        con = sqlite3.connect(":memory:")
-        df = pd.DataFrame(self.ddh.data, columns=self.ddh.header)
-        df.to_sql("df", con, if_exists="replace")
-        query = """
-            SELECT
-                 {col},
-                 COUNT({col}) AS "Count",
-                 SUM({cost}) AS "Sum"
-             FROM df
-             GROUP BY {col}
-             ORDER BY Sum DESC
-        """.format(col=column_name, cost=cost_column)
-
-        sql_group = pd.read_sql(query, con)
-        header = list(sql_group)
-        data = [list(row) for row in sql_group.values]
-
-        return header, data
+        return self.aggregate(aggregate.GroupBy(column_name, (
+            aggregate.Aggregate("Count", aggregate.COUNT, column_name),
+            aggregate.Aggregate("Sum", aggregate.SUM, cost_column),
+        ), order_by="Sum"))
 
     def sum_and_count_by_column_chart(
         self, column_name, cost_column, top, left, name
@@ -336,24 +297,20 @@ class SheetComputeRI(Sheet):
     name = "RIs"
     title = "EC2 RI Recommendations"
     calls = (ComputeRI,)
-    clean = {
-        6 : clean_money,
-        7 : clean_money,
-        8 : clean_money,
-        9 : clean_money,
-    }
-
-    def clean_data(self):
-        new_data = []
-        for row in self.ddh.data:
-            new_row = []
-            for cell in row:
-                if isinstance(cell, Decimal):
-                    new_row.append(float(cell))
-                    continue
-                new_row.append(cell)
-            new_data.append(new_row)
-        return new_data
+    savings = aggregate.GroupBy("Instance Type", (
+        aggregate.Aggregate(
+            "On-Demand Instance Cost",
+            aggregate.SUM,
+            "On-Demand Monthly Cost",
+            annual_cost,
+        ),
+        aggregate.Aggregate(
+            "RI Cost",
+            aggregate.SUM,
+            ("Reserved Monthly Cost", "Upfront RI Cost"),
+            annual_ri_cost,
+        ),
+    ))
 
     def put_two_series_chart(
         self, title, top, left, data_loc, chart_type, formatting
@@ -391,29 +348,8 @@ class SheetComputeRI(Sheet):
         return self.sheet
 
     def sum_by(self):
-        """Sum rows in data grouping by values in the column specified"""
-        # Create data with correct float values
-
-        new_data = self.clean_data()
-
-        con = sqlite3.connect(":memory:")
-        df = pd.DataFrame(new_data, columns=self.ddh.header)
-        df.to_sql("df", con, if_exists="replace")
-        query = """
-            SELECT
-                "Instance Type",
-                SUM("On-Demand Monthly Cost"*12) AS "On-Demand Instance Cost",
-                SUM("Reserved Monthly Cost"*12+"Upfront RI Cost") AS "RI Cost"
-            FROM df
-            GROUP BY "Instance Type"
-            ORDER BY "On-Demand Instance Cost" DESC
-        """
-
-        sql_group = pd.read_sql(query, con)
-        header = list(sql_group)
-        data_ = [list(row) for row in sql_group.values]
-
-        return header, data_
+        """Sum the annual costs of each instance type."""
+        return self.aggregate(self.savings)
 
     def sum_by_column_chart(
         self, column_name, top, left, name
@@ -421,18 +357,9 @@ class SheetComputeRI(Sheet):
         """Insert a column chart with data specified."""
         table_top = top + 1  # Account for label.
 
-        # Get first 4 data rows
+        # Keep the first 4 rows and roll the rest up into "Other".
         header, data_ = self.sum_by()
-        data = data_[:4]
-
-        # Rollup remaining values into "other" column
-        od_cost_values = [item[1] for item in data_[:4]]
-        ri_cost_values = [item[2] for item in data_[:4]]
-        other_row = ["Other", sum(od_cost_values), sum(ri_cost_values)]
-
-        # Append data
-        data.append(other_row)
-        data = sorted(data, key=itemgetter(1), reverse=True)
+        data = aggregate.top(header, data_, 4)
         sums = DDH(header=header, data=data)
 
         self.put_label(column_name, top, self.table_left)
@@ -490,36 +417,20 @@ class SheetComputeUnderutilized(Sheet):
     name = "Underutil"
     title = "EC2 Underutilized Instances"
     calls = (ComputeDetails, ComputeUnderutilized)
-    clean = {
-        3 : clean_percent,
-        4 : clean_money,
-    }
+    cost_by_environment = aggregate.GroupBy(
+        "Environment",
+        (aggregate.Aggregate("Cost", aggregate.SUM, "Predicted Monthly Cost"),),
+        expression=environment_label,
+    )
 
     def predicted_cost_by_environment(self, top=0, left=0):
-        con = self.con
-        CD, UU = self.calls
-        df = pd.DataFrame(self.ddh.data, columns=self.ddh.header)
-        df.to_sql("df", con, if_exists="replace")
-        sql_group = pd.read_sql("""
-            SELECT
-                CASE "Environment"
-                    WHEN '' THEN 'No environment'
-                    ELSE "Environment"
-                END AS "Environment",
-                SUM("Predicted Monthly Cost") AS "Cost"
-            FROM
-                df
-            WHERE "Average CPU Util" IS NOT NULL
-            GROUP BY "Environment"
-            ORDER BY SUM("Predicted Monthly Cost") DESC
-        """, con)
+        header, data = self.aggregate(self.cost_by_environment)
 
         # Account for hidden column
         table_left = left + self.chart_width + self.cell_spacing + 1
         table_top = top + self.cell_spacing + 1
 
-        data = [list(row) for row in sql_group.values]
-        ddh = DDH(data=data, header=list(sql_group.columns))
+        ddh = DDH(data=data, header=header)
 
         self.put_label("Predicted Monthly Cost", table_top-1, table_left)
         # Write the data table to the sheet.
@@ -568,10 +479,7 @@ class SheetComputeUnderutilized(Sheet):
             ORDER BY cd."Environment" DESC
         """.format(cd=CD.slug, uu=UU.slug), con)
         header = cu_df.columns
-        cu_data = [[
-            self.clean.get(index, lambda x:x)(row[index])
-            for index in range(len(header))
-        ] for row in cu_df.values]
+        cu_data = self.apply_clean(cu_df.values)
         cu_ddh = DDH(data=cu_data, header=list(header))
         self._ddh = cu_ddh
         return self._ddh
@@ -621,8 +529,5 @@ class SheetStorageDetached(Sheet):
     name = "DetachedStorage"
     title = "Detached Storage"
     calls = (StorageDetached,)
-    clean = {
-        2 : clean_money,
-    }
 
 
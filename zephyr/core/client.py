@@ -1,18 +1,29 @@
 import os
+import re
 import sqlite3
 
-import pandas as pd
-
 from datetime import datetime
 from shutil import rmtree
 
-from timeout_decorator import timeout
+from botocore.exceptions import BotoCoreError, ClientError
 
+from . import accounts, cache, schema
 from .aws import utils as aws
+from .aws import uploader
 from .ddh import DDH
-from .utils import get_config_values
+from .manifest import Manifest
+from .utils import first_of_previous_month, get_config_values
+
+MB = 2**20
+MONTH = re.compile(r"^\d{4}-\d{2}$")
 
 class Client(object):
+    # Whether responses are cached per account and month, see cache_key.
+    cached_by_account = True
+    response = None
+    # The types of the header columns, see schema. Others load as they are.
+    types = dict()
+
     @classmethod
     def cache_key(cls, account, date):
         month = datetime.strptime(date, "%Y-%m-%d").strftime("%Y-%m")
@@ -35,20 +46,24 @@ class Client(object):
         self.ZEPHYR_S3_BUCKET = None
         self.config = config
         self.log = log
-        self.session = None
+
+    @property
+    def accounts(self):
+        return accounts.get_index(self.database_path)
 
     @property
     def database(self):
         if(self._database):
             return self._database
-        db_path = os.path.join(
-            self.ZEPHYR_CACHE_ROOT,
-            self.ZEPHYR_DATABASE
-        )
-        db_exists = os.path.isfile(db_path)
-        self._database = sqlite3.connect(db_path)
+        db_path = self.database_path
+        # Books fetch on a thread pool, so connections may change threads.
+        self._database = sqlite3.connect(db_path, check_same_thread=False)
         return self._database
 
+    @property
+    def database_path(self):
+        return os.path.join(self.ZEPHYR_CACHE_ROOT, self.ZEPHYR_DATABASE)
+
     @property
     def ddh(self):
         return self._ddh
@@ -57,6 +72,10 @@ class Client(object):
     def ddh(self, value):
         self._ddh = value
 
+    @property
+    def manifest(self):
+        return Manifest(self.ZEPHYR_CACHE_ROOT)
+
     @property
     def s3(self):
         if self._s3:
@@ -70,8 +89,7 @@ class Client(object):
         self.AWS_ACCESS_KEY_ID = key_id
         self.AWS_SECRET_ACCESS_KEY = secret
         self.ZEPHYR_S3_BUCKET = bucket
-        self.session = aws.get_session(key_id, secret)
-        self._s3 = self.session.resource("s3")
+        self._s3 = aws.get_s3_client(key_id, secret)
         return self._s3
 
     def cache(self, response, cache_key):
@@ -80,13 +98,18 @@ class Client(object):
             api=self.name,
             call=self.slug,
         ))
-        with open(cache_local, "w") as f:
-            f.write(response)
+        cache.write(cache_local, response)
+        self.cached(cache_key)
+
+    def cached(self, cache_key):
+        """Record a freshly written local entry and queue it for S3."""
+        cache_local = os.path.join(self.ZEPHYR_CACHE_ROOT, cache_key)
+        self.manifest.touch(cache_key)
         self.log.info("Caching {api} response for {call} in S3.".format(
             api=self.name,
             call=self.slug,
         ))
-        aws.put_s3(self.s3, cache_local, self.ZEPHYR_S3_BUCKET, cache_key)
+        self.put_s3(cache_local, cache_key)
 
     def cache_policy(self, account, date, expired):
         # If local exists and expired is false then use the local cache
@@ -96,77 +119,281 @@ class Client(object):
         cache_local_exists = os.path.isfile(cache_local)
         if(cache_local_exists and not expired):
             self.log.info("Using cached response: {cache}".format(cache=cache_local))
-            with open(cache_local, "r") as f:
-                return f.read()
-        # If local does not exist and expired is false then check s3
-        cache_s3 = self.get_s3(cache_key)
-        if(cache_s3 and not expired):
-            self.log.info("Using cached response for {} from S3.".format(self.slug))
-            with open(cache_local, "wb") as cache_fd:
-                cache_fd.write(cache_s3)
-            return cache_s3.decode("utf-8")
-        # If we are this far then contact the API and cache the result
-        self.log.info("Retrieving data for {call} from {api}.".format(
-            api=self.name,
-            call=self.slug,
-        ))
+            self.manifest.touch(cache_key)
+            return self.read_entry(cache_local)
+        seen = cache.mtime(cache_local)
+        with cache.lock(cache_local):
+            # Another process may have written the entry while we waited.
+            written = cache.mtime(cache_local)
+            if(written is not None and (not expired or written != seen)):
+                self.log.info("Using cached response: {cache}".format(cache=cache_local))
+                return self.read_entry(cache_local)
+            # If local does not exist and expired is false then check s3,
+            # but only when the manifest says the key is there.
+            if(
+                not expired
+                and self.in_s3(cache_key)
+                and self.get_s3(cache_key, cache_local)
+            ):
+                self.log.info("Using cached response for {} from S3.".format(self.slug))
+                self.manifest.touch(cache_key)
+                return self.read_entry(cache_local)
+            # If we are this far then contact the API and cache the result
+            self.log.info("Retrieving data for {call} from {api}.".format(
+                api=self.name,
+                call=self.slug,
+            ))
+            response = self.fill(account, date, cache_key)
+        return response
+
+    def load(self, account, date, expired):
+        """
+        Fetch and parse a response, only once per client. The response is
+        dropped once parsed, since the data holds what is needed of it.
+        """
+        if self.ddh is None:
+            self.parse(self.fetch(account, date, expired))
+            self.to_ddh()
+            self.response = None
+        return self.ddh
+
+    def evict_cache(self):
+        """
+        Evict the least recently used entries from the local cache once it
+        is larger than ZEPHYR_CACHE_SIZE_MB. S3 keeps every entry, so evicted
+        entries are fetched from there again when needed. Metadata, recent
+        months and entries still waiting for upload are never evicted.
+        Eviction runs at most once per EVICT_TTL across commands.
+        """
+        limit = int(self.config.get(
+            "zephyr", "ZEPHYR_CACHE_SIZE_MB", fallback="0"
+        ) or 0)
+        if not limit or not self.manifest.evict_due():
+            return []
+        recent = first_of_previous_month().strftime("%Y-%m")
+        uploading = uploader.pending_keys(self.ZEPHYR_CACHE_ROOT)
+
+        def pinned(key):
+            parts = key.split(os.sep)
+            # Only <account>/<month>/<entry> files are cache entries.
+            if len(parts) != 3 or not MONTH.match(parts[1]):
+                return True
+            return parts[1] >= recent or key in uploading
+
+        evicted = cache.evict(
+            self.ZEPHYR_CACHE_ROOT,
+            limit * MB,
+            self.manifest.accessed(),
+            pinned,
+        )
+        self.manifest.forget(evicted)
+        if evicted:
+            self.log.info(
+                "Evicted {count} files from {cache_root}.".format(
+                    count=len(evicted), cache_root=self.ZEPHYR_CACHE_ROOT)
+            )
+        return evicted
+
+    def fill(self, account, date, cache_key):
+        """Request a response from the API and cache it."""
         response = self.request(account, date)
         self.cache(response, cache_key)
         return response
 
+    def fetch(self, account, date, expired):
+        """Get a response through the cache policy, only once per client."""
+        if self.response is None:
+            self.response = self.cache_policy(account, date, expired)
+        return self.response
+
     def clear_cache_s3(self, account, month):
-        # Lists objects in the desired directory
-        cache_s3 = os.path.join(account, month)
-        objects = self.s3.meta.client.list_objects(
-            Bucket=self.ZEPHYR_S3_BUCKET,
-            Prefix="{}".format(cache_s3)
-        )
+        """Delete the objects cached in S3 for an account and month."""
+        cache_s3 = os.path.join(account, month, "")
+        keys = [
+            obj["Key"]
+            for obj in aws.list_s3(self.s3, self.ZEPHYR_S3_BUCKET, cache_s3)
+        ]
+        return self.delete_s3(keys, cache_s3)
 
-        # Delete files from folder in S3 if they exist
-        if "Contents" not in objects:
-            return
-        count = 0
-        for obj in objects["Contents"]:
-            self.log.debug("Deleting {}".format(obj["Key"]))
-            self.s3.meta.client.delete_object(
-                Bucket=self.ZEPHYR_S3_BUCKET,
-                Key=obj["Key"]
-            )
-            count += 1
-        self.log.info(
-            "Deleted {count} files from {cache_s3} in S3".format(
-                count=count, cache_s3=cache_s3)
-        )
+    def clear_cache_s3_month(self, month):
+        """
+        Delete the objects cached in S3 for a month across all accounts
+        from a single listing of the bucket.
+        """
+        keys = [
+            obj["Key"]
+            for obj in aws.list_s3(self.s3, self.ZEPHYR_S3_BUCKET)
+            if obj["Key"].split("/")[1:2] == [month]
+        ]
+        return self.delete_s3(keys, os.path.join("*", month, ""))
 
     def clear_cache_local(self, account, month):
-        # Delete directory locally
-        cache_local = os.path.join(self.ZEPHYR_CACHE_ROOT, account, month)
-        if not os.path.exists(os.path.expanduser(cache_local)):
+        # Delete directory locally, when there is one to delete.
+        cache_local = os.path.expanduser(
+            os.path.join(self.ZEPHYR_CACHE_ROOT, account, month)
+        )
+        try:
+            count = len(os.listdir(cache_local))
+            rmtree(cache_local)
+        except (FileNotFoundError, NotADirectoryError):
             return
-        count = len(os.listdir(cache_local))
-        rmtree(cache_local)
         self.log.info(
             "Deleted {count} files from {cache_local}.".format(
                 count=count, cache_local=cache_local)
         )
 
+    def clear_cache_local_month(self, month):
+        """Delete the local cache for a month across all accounts."""
+        cache_root = os.path.expanduser(self.ZEPHYR_CACHE_ROOT)
+        if not os.path.isdir(cache_root):
+            return
+        for account in sorted(os.listdir(cache_root)):
+            self.clear_cache_local(account, month)
+
+    def delete_s3(self, keys, cache_s3):
+        """Delete keys from S3 in batches and drop them from the manifest."""
+        for key in keys:
+            self.log.debug("Deleting {}".format(key))
+        errors = set(aws.delete_s3(self.s3, self.ZEPHYR_S3_BUCKET, keys))
+        for key in errors:
+            self.log.error("Could not delete {}".format(key))
+        deleted = [key for key in keys if key not in errors]
+        self.manifest.remove(self.ZEPHYR_S3_BUCKET, deleted)
+        self.log.info(
+            "Deleted {count} files from {cache_s3} in S3".format(
+                count=len(deleted), cache_s3=cache_s3)
+        )
+        return deleted
+
     def get_account_by_slug(self, slug):
         raise NotImplementedError
 
-    def get_s3(self, cache_key):
-        return aws.get_s3(self.s3, self.ZEPHYR_S3_BUCKET, cache_key)
+    def in_s3(self, cache_key):
+        """Decide from the manifest whether a key is worth a GET from S3."""
+        if not self.sync_manifest():
+            # Without a manifest fall back to asking S3 directly.
+            return bool(self.ZEPHYR_S3_BUCKET)
+        exists = self.manifest.exists(self.ZEPHYR_S3_BUCKET, cache_key)
+        return exists is not False
+
+    def read_entry(self, path):
+        """Read a cache entry into a response."""
+        return cache.read(path)
+
+    def read_cached(self, account, date):
+        """Read a response from the local cache or S3, but never the API."""
+        cache_key = self.cache_key(account, date)
+        cache_local = os.path.join(self.ZEPHYR_CACHE_ROOT, cache_key)
+        if not os.path.isfile(cache_local):
+            os.makedirs(os.path.dirname(cache_local), exist_ok=True)
+            if not (
+                self.in_s3(cache_key)
+                and self.get_s3(cache_key, cache_local)
+            ):
+                return None
+        self.manifest.touch(cache_key)
+        return self.read_entry(cache_local)
+
+    def is_cached(self, account, date):
+        """Whether a response is cached locally or, as far as we know, in S3."""
+        cache_key = self.cache_key(account, date)
+        cache_local = os.path.join(self.ZEPHYR_CACHE_ROOT, cache_key)
+        return os.path.isfile(cache_local) or self.in_s3(cache_key)
+
+    def migrate_cache_local(self):
+        """Compress the cached responses written in the old format."""
+        count = 0
+        for path in cache.entries(self.ZEPHYR_CACHE_ROOT):
+            if not cache.compress_file(path):
+                continue
+            self.log.debug("Compressed {}".format(path))
+            count += 1
+        self.log.info(
+            "Compressed {count} files in {cache_root}.".format(
+                count=count, cache_root=self.ZEPHYR_CACHE_ROOT)
+        )
+        return count
+
+    def migrate_cache_s3(self):
+        """Compress the responses cached in S3 in the old format."""
+        s3 = self.s3
+        paginator = s3.get_paginator("list_objects_v2")
+        count = 0
+        for page in paginator.paginate(Bucket=self.ZEPHYR_S3_BUCKET):
+            for obj in page.get("Contents", []):
+                key = obj["Key"]
+                if not key.endswith(cache.EXTENSIONS):
+                    continue
+                # The format marker is in the first bytes of each entry.
+                head = s3.get_object(
+                    Bucket=self.ZEPHYR_S3_BUCKET,
+                    Key=key,
+                    Range="bytes=0-{}".format(len(cache.GZIP_MAGIC) - 1),
+                )["Body"].read()
+                if cache.is_compressed(head):
+                    continue
+                blob = s3.get_object(
+                    Bucket=self.ZEPHYR_S3_BUCKET,
+                    Key=key,
+                )["Body"].read()
+                self.log.debug("Compressing {}".format(key))
+                s3.put_object(
+                    ACL="bucket-owner-full-control",
+                    Body=cache.compress(blob),
+                    Bucket=self.ZEPHYR_S3_BUCKET,
+                    Key=key,
+                )
+                count += 1
+        self.log.info("Compressed {} files in S3.".format(count))
+        return count
+
+    def get_s3(self, cache_key, filename):
+        return aws.get_s3(self.s3, self.ZEPHYR_S3_BUCKET, cache_key, filename)
+
+    def get_account(self, slug):
+        """Look up the IDs of an account in every backend, or None."""
+        return self.accounts.get(slug)
 
     def get_slugs(self):
-        query = ("""
-            SELECT aws."Name" AS slug
-            FROM
-                sf_projects AS p LEFT OUTER JOIN
-                sf_aws AS aws ON (p.Id=aws.Assoc_Project__c)
-            WHERE aws."Name" IS NOT NULL
-            ORDER BY aws."Name"
-        """)
-        slugs = DDH.read_sql(query, self.database)
-        return list(zip(*slugs.data))[0]
+        return tuple(
+            slug for slug, account in self.accounts.items()
+            if slug is not None and account.project is not None
+        )
+
+    def put_s3(self, filename, cache_key):
+        """
+        Queue a file for upload to S3 in the background. The manifest
+        records it once the upload is done.
+        """
+        s3 = self.s3
+        if not self.ZEPHYR_S3_BUCKET:
+            return
+        bucket = self.ZEPHYR_S3_BUCKET
+        cache_root = self.ZEPHYR_CACHE_ROOT
+        uploader.get_uploader(cache_root).put(
+            s3, filename, bucket, cache_key, self.log,
+            callback=uploader.in_manifest(
+                cache_root, filename, bucket, cache_key
+            ),
+        )
+
+    def sync_manifest(self):
+        """
+        Sync the manifest from one listing of the bucket per run. Return
+        whether the manifest can be trusted for lookups.
+        """
+        s3 = self.s3
+        if not self.ZEPHYR_S3_BUCKET:
+            return False
+        try:
+            if self.manifest.sync_once(s3, self.ZEPHYR_S3_BUCKET):
+                self.log.info("Synced the cache manifest from S3.")
+        except (BotoCoreError, ClientError) as e:
+            self.log.warning(
+                "Could not sync the cache manifest from S3: {}".format(e)
+            )
+            return False
+        return True
 
     def to_ddh(self):
         self.ddh = DDH(header=self.header, data=self.data)
@@ -174,6 +401,31 @@ class Client(object):
 
     def to_sql(self, name, con):
         ddh = self.to_ddh()
-        data = [[str(cell) for cell in row] for row in ddh.data]
-        df = pd.DataFrame(data, columns=self.ddh.header)
-        df.to_sql(name, con)
+        schema.load(con, name, ddh.header, ddh.data, self.types)
+
+
+class Registry(object):
+    """
+    Share one client per call, account and date among the sheets of a run so
+    that each response is fetched, parsed and loaded into SQL only once.
+    """
+    def __init__(self, config, log=None):
+        self.clients = dict()
+        self.con = schema.connect()
+        self.config = config
+        self.log = log
+        self.tables = set()
+
+    def client(self, Call, account, date):
+        key = (Call.slug, account, date)
+        if key not in self.clients:
+            self.clients[key] = Call(config=self.config, log=self.log)
+        return self.clients[key]
+
+    def to_sql(self, client):
+        """Load the data of a client into the shared connection once."""
+        if client.slug in self.tables:
+            return
+        ddh = client.ddh
+        schema.load(self.con, client.slug, ddh.header, ddh.data, client.types)
+        self.tables.add(client.slug)
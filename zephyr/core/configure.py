@@ -40,17 +40,23 @@ CRED_ITEMS = [
     ),
     (
         "zephyr", [
+            "ZEPHYR_CACHE_DELTAS",
             "ZEPHYR_CACHE_ROOT",
+            "ZEPHYR_CACHE_SIZE_MB",
             "ZEPHYR_DATABASE",
             "ZEPHYR_LINE_WIDTH",
             "ZEPHYR_TEST_DATABASE",
+            "ZEPHYR_XLSX_CONSTANT_MEMORY",
         ],
     ),
 ]
 DEFAULTS = {
+    "ZEPHYR_CACHE_DELTAS": "0",  # Store full inventories
     "ZEPHYR_CACHE_ROOT": os.path.expanduser("~/.zephyr/cache/"),
+    "ZEPHYR_CACHE_SIZE_MB": "0",  # No limit
     "ZEPHYR_DATABASE": ".meta/local.db",
     "ZEPHYR_TEST_DATABASE": ".meta/test.db",
+    "ZEPHYR_XLSX_CONSTANT_MEMORY": "0",  # Keep workbooks in memory
 }
 
 def create_config(config, prompt=None, write=None, ini=None):
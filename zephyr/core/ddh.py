@@ -1,4 +1,5 @@
 import csv
+import datetime
 import io
 import json
 
@@ -6,6 +7,14 @@ import texttable
 
 from .utils import ZephyrEncoder
 
+# Times are shown as sheets display them.
+DATETIME_FORMAT = "%m/%d/%y %H:%M"
+
+def format_cell(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime(DATETIME_FORMAT)
+    return value
+
 class DDH(object):
     def __init__(self, header=None, data=None):
         self.header = header or []
@@ -33,19 +42,22 @@ class DDH(object):
         writer = csv.DictWriter(out, fieldnames=fieldnames, *args, **kwargs)
         writer.writeheader()
         for row in self.data:
-            writer.writerow(dict(zip(fieldnames, row)))
+            writer.writerow(dict(zip(fieldnames, map(format_cell, row))))
         return out.getvalue()
 
     def to_json(self, *args, **kwargs):
         kwargs = self._discard_keys(kwargs, ("line_width", "template"))
-        out = dict(header=self.header, data=self.data)
+        data = [[format_cell(value) for value in row] for row in self.data]
+        out = dict(header=self.header, data=data)
         return json.dumps(out, cls=ZephyrEncoder, *args, **kwargs)
 
     def to_table(self, *args, **kwargs):
         kwargs = self._discard_keys(kwargs, ("template"))
         ncols = len(self.header)
         col_width = max(int(kwargs.get("line_width", 120)/ncols), 8)
-        rows = sum([[self.header], self.data], [])
+        rows = [self.header] + [
+            [format_cell(value) for value in row] for row in self.data
+        ]
         out = texttable.Texttable()
         out.set_cols_dtype(["t"]*ncols)
         out.set_cols_width((col_width,)*ncols)
@@ -2,12 +2,22 @@ import csv
 import datetime
 import json
 
+from .. import schema
 from . import client as dy
 from ..ddh import DDH
 from ..utils import ZephyrEncoder
 
 class Billing(dy.Dynamics):
     slug="billing"
+    types = {
+        "Description": schema.TEXT,
+        "Due Date": schema.TEXT,
+        "Invoice Date": schema.TEXT,
+        "Line Item": schema.TEXT,
+        "Quantity": schema.REAL,
+        "Subtotal": schema.REAL,
+        "Unit": schema.REAL,
+    }
 
     def __init__(self, config=None, log=None, **kwargs):
         if(config):
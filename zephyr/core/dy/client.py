@@ -1,4 +1,3 @@
-import pandas as pd
 import pymssql
 
 from ..client import Client
@@ -25,23 +24,12 @@ class Dynamics(Client):
         return self._dy
 
     def get_account_by_slug(self, slug):
-        name = pd.read_sql("""
-            SELECT a.name AS slug, p."Dynamics_ID__c" AS dy_name
-            FROM
-                sf_aws AS a LEFT OUTER JOIN
-                sf_projects AS p ON (p."Id" = a."Assoc_Project__c")
-            WHERE a.name = :slug
-            """,
-            self.database,
-            params=dict(slug=slug),
-        )["dy_name"]
-
-        if not len(name):
+        account = self.get_account(slug)
+        if account is None:
             raise ZephyrException(
                 "No matching Dynamics ID found in Salesforce."
             )
-
-        return name[0]
+        return account.dy_name
 
     def request(self, account):
         raise NotImplementedError
@@ -1,63 +1,47 @@
-import sqlite3
-import pandas as pd
-
+from .. import aggregate
 from ..ddh import DDH
 from ..sheet import Sheet
 from .calls import Billing
 
 
+def month(date):
+    """The YYYY-MM month of a YYYY-MM-DD date."""
+    return date[:7]
+
+
 class SheetBilling(Sheet):
     name = "Billing"
     title = "Billing Line Items"
     calls = (Billing,)
 
+    by_lineitem = aggregate.GroupBy(
+        "Line Item",
+        (
+            aggregate.Aggregate("Description", aggregate.LAST, "Description"),
+            aggregate.Aggregate("Total", aggregate.SUM, "Subtotal"),
+        ),
+        where=("Line Item", aggregate.NE_NOCASE, "***Note"),
+        order_by="Total",
+    )
+    by_month = aggregate.GroupBy(
+        "Invoice Date",
+        (aggregate.Aggregate("Total", aggregate.SUM, "Subtotal"),),
+        order_by="Month",
+        descending=False,
+        name="Month",
+        expression=month,
+    )
+    group_bys = (by_lineitem, by_month)
+
     def group_by_lineitem(self):
         """Groups rows by line item"""
-        con = sqlite3.connect(":memory:")
-        df = pd.DataFrame(self.ddh.data, columns=self.ddh.header)
-        df.to_sql("df", con, if_exists="replace")
-        query = """
-            SELECT
-                "Line Item",
-                Description,
-                SUM(Subtotal) as "Total"
-            FROM df
-            WHERE "Line Item" NOT LIKE '***Note'
-            GROUP BY
-                "Line Item"
-            ORDER BY "Total" DESC
-        """
-
-        sql_group = pd.read_sql(query, con)
-        header = list(sql_group)
-        data = [list(row) for row in sql_group.values]
-
-        ddh = DDH(header=header, data=data)
-
-        return ddh
+        header, data = self.aggregate(self.by_lineitem)
+        return DDH(header=header, data=data)
 
     def group_by_month(self):
         """Groups rows by month"""
-        con = sqlite3.connect(":memory:")
-        df = pd.DataFrame(self.ddh.data, columns=self.ddh.header)
-        df.to_sql("df", con, if_exists="replace")
-        query = """
-            SELECT
-                SUBSTR("Invoice Date", 0, 8) as "Month",
-                SUM("Subtotal") as "Total"
-            FROM df
-            GROUP BY
-                "Month"
-            ORDER BY "Month"
-        """
-
-        sql_group = pd.read_sql(query, con)
-        header = list(sql_group)
-        data = [list(row) for row in sql_group.values]
-
-        ddh = DDH(header=header, data=data)
-
-        return ddh
+        header, data = self.aggregate(self.by_month)
+        return DDH(header=header, data=data)
 
     def to_xlsx(self, book, **kwargs):
         """Format the Billing sheet."""
@@ -80,18 +64,26 @@ class SheetBilling(Sheet):
 
         n_cols = len(self.ddh.header)
         table_width = n_cols + self.cell_spacing
+        aggs_top = 0
+        if self.streaming:
+            # Rows above the last one written are gone, so the aggregates
+            # go below the line items instead of beside them.
+            table_width = 0
+            aggs_top = len(self.ddh.data) + 2 + self.cell_spacing
 
         aggs_ddh = self.group_by_lineitem()
 
-        self.put_label(aggs_title, left=table_width)
+        self.put_label(aggs_title, top=aggs_top, left=table_width)
 
-        self.put_table(aggs_ddh, self.cell_spacing, table_width, aggs_name)
+        self.put_table(
+            aggs_ddh, aggs_top + self.cell_spacing, table_width, aggs_name
+        )
 
         aggs_n_rows = len(aggs_ddh.data)
         aggs_table_height = aggs_n_rows + self.cell_spacing
         monthly_ddh = self.group_by_month()
         # Account for label
-        monthly_top = 1 + aggs_table_height + self.cell_spacing
+        monthly_top = aggs_top + 1 + aggs_table_height + self.cell_spacing
 
         self.put_label(monthly_title, top=monthly_top, left=table_width)
 
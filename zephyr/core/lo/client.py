@@ -1,4 +1,3 @@
-import pandas as pd
 import requests
 
 from ..client import Client
@@ -35,23 +34,12 @@ class Logicops(Client):
         return self._LO_API_BASE
 
     def get_account_by_slug(self, slug):
-        name = pd.read_sql("""
-            SELECT a.name AS slug, l.name AS lo_name
-            FROM
-                sf_aws AS a LEFT OUTER JOIN
-                sf_projects AS p ON (p."Id" = a."Assoc_Project__c") LEFT OUTER JOIN
-                lo_accounts AS l ON (p.LogicOps_ID__c = l.id)
-            WHERE a.name = '{slug}'
-            """.format(slug=slug),
-            self.database
-        )["lo_name"]
-
-        if not len(name):
+        account = self.get_account(slug)
+        if account is None:
             raise ZephyrException(
                 "No matching Logicops ID found in Salesforce."
             )
-
-        return name[0]
+        return account.lo_name
 
     def request(self, account):
         raise NotImplementedError
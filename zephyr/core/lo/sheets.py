@@ -1,3 +1,4 @@
+from .. import aggregate
 from ..sheet import Sheet
 from .calls import ServiceRequests
 
@@ -6,6 +7,7 @@ class SheetSRs(Sheet):
     name = "SRs"
     title = "Service Requests"
     calls = (ServiceRequests,)
+    group_bys = (aggregate.count_by("Area"), aggregate.count_by("Severity"))
 
     def to_xlsx(self, book, **kwargs):
         """Format the SR sheet."""
@@ -0,0 +1,177 @@
+import os
+import sqlite3
+import threading
+import time
+
+from contextlib import closing, contextmanager
+
+MANIFEST = ".meta/manifest.db"
+# Another process of the same run may have synced the manifest already.
+SYNC_TTL = 600
+# Eviction walks the whole local cache, so commands share one run of it.
+EVICT_TTL = 3600
+
+_created = set()
+_lock = threading.RLock()
+_synced = set()
+
+
+class Manifest(object):
+    """
+    A sqlite index of the objects in the S3 cache. It is synced from one
+    listing of the bucket per run so that hits and misses, including
+    negative lookups, are decided locally instead of by a GET per key.
+    """
+    def __init__(self, cache_root):
+        self.path = os.path.join(cache_root, MANIFEST)
+
+    @contextmanager
+    def connect(self):
+        """A connection in a transaction, committed and closed on exit."""
+        self.create()
+        con = sqlite3.connect(self.path, timeout=30)
+        try:
+            with con:
+                yield con
+        finally:
+            con.close()
+
+    def create(self):
+        """Create the tables, once per process."""
+        with _lock:
+            if self.path in _created:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with closing(sqlite3.connect(self.path, timeout=30)) as con, con:
+                con.execute("""
+                    CREATE TABLE IF NOT EXISTS s3_objects (
+                        bucket TEXT,
+                        key TEXT,
+                        size INTEGER,
+                        etag TEXT,
+                        fetched REAL,
+                        PRIMARY KEY (bucket, key)
+                    )
+                """)
+                con.execute("""
+                    CREATE TABLE IF NOT EXISTS s3_syncs (
+                        bucket TEXT PRIMARY KEY,
+                        synced REAL
+                    )
+                """)
+                con.execute("""
+                    CREATE TABLE IF NOT EXISTS local_access (
+                        key TEXT PRIMARY KEY,
+                        accessed REAL
+                    )
+                """)
+                con.execute("""
+                    CREATE TABLE IF NOT EXISTS local_evictions (
+                        evicted REAL
+                    )
+                """)
+            _created.add(self.path)
+
+    def accessed(self):
+        """Map each local cache key to the time it was last used."""
+        with self.connect() as con:
+            return dict(con.execute("SELECT key, accessed FROM local_access"))
+
+    def add(self, bucket, key, size, etag):
+        with self.connect() as con:
+            con.execute("""
+                INSERT OR REPLACE INTO s3_objects VALUES (?, ?, ?, ?, ?)
+            """, (bucket, key, size, etag, time.time()))
+
+    def evict_due(self):
+        """
+        Claim the next eviction of the local cache, unless one ran less than
+        EVICT_TTL seconds ago.
+        """
+        now = time.time()
+        with _lock, self.connect() as con:
+            # Other processes wait here, then see the claim made.
+            con.execute("BEGIN IMMEDIATE")
+            row = con.execute("SELECT MAX(evicted) FROM local_evictions")
+            evicted = row.fetchone()[0]
+            if evicted is not None and now - evicted < EVICT_TTL:
+                return False
+            con.execute("DELETE FROM local_evictions")
+            con.execute("INSERT INTO local_evictions VALUES (?)", (now,))
+        return True
+
+    def exists(self, bucket, key):
+        """
+        True or False when the manifest knows whether the key is in S3, and
+        None when the manifest has never been synced for this bucket.
+        """
+        if self.synced(bucket) is None:
+            return None
+        return self.get(bucket, key) is not None
+
+    def get(self, bucket, key):
+        with self.connect() as con:
+            return con.execute("""
+                SELECT key, size, etag, fetched
+                FROM s3_objects
+                WHERE bucket = ? AND key = ?
+            """, (bucket, key)).fetchone()
+
+    def forget(self, keys):
+        """Drop local cache keys from the access index."""
+        with self.connect() as con:
+            con.executemany("""
+                DELETE FROM local_access WHERE key = ?
+            """, [(key,) for key in keys])
+
+    def remove(self, bucket, keys):
+        with self.connect() as con:
+            con.executemany("""
+                DELETE FROM s3_objects WHERE bucket = ? AND key = ?
+            """, [(bucket, key) for key in keys])
+
+    def sync(self, s3, bucket):
+        """Replace the entries for a bucket with a full listing of it."""
+        now = time.time()
+        paginator = s3.get_paginator("list_objects_v2")
+        rows = [
+            (bucket, obj["Key"], obj["Size"], obj["ETag"], now)
+            for page in paginator.paginate(Bucket=bucket)
+            for obj in page.get("Contents", [])
+        ]
+        with self.connect() as con:
+            con.execute("DELETE FROM s3_objects WHERE bucket = ?", (bucket,))
+            con.executemany("""
+                INSERT OR REPLACE INTO s3_objects VALUES (?, ?, ?, ?, ?)
+            """, rows)
+            con.execute("""
+                INSERT OR REPLACE INTO s3_syncs VALUES (?, ?)
+            """, (bucket, now))
+        _synced.add((self.path, bucket))
+        return len(rows)
+
+    def sync_once(self, s3, bucket):
+        """Sync unless this run, or one just before it, already has."""
+        with _lock:
+            if (self.path, bucket) in _synced:
+                return False
+            synced = self.synced(bucket)
+            if synced is not None and time.time() - synced < SYNC_TTL:
+                _synced.add((self.path, bucket))
+                return False
+            self.sync(s3, bucket)
+            return True
+
+    def touch(self, key):
+        """Record that a local cache entry was used."""
+        with self.connect() as con:
+            con.execute("""
+                INSERT OR REPLACE INTO local_access VALUES (?, ?)
+            """, (key, time.time()))
+
+    def synced(self, bucket):
+        with self.connect() as con:
+            row = con.execute("""
+                SELECT synced FROM s3_syncs WHERE bucket = ?
+            """, (bucket,)).fetchone()
+        return row[0] if row else None
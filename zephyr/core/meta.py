@@ -32,11 +32,8 @@ class LWProjects(Client):
         """
         if(not db_exists and not expired):
             self.log.info("Checking S3 for cached copy of database.")
-            cache_s3 = aws.get_s3(s3, self.ZEPHYR_S3_BUCKET, zdb)
-            if(cache_s3):
+            if(aws.get_s3(s3, self.ZEPHYR_S3_BUCKET, zdb, db)):
                 self.log.info("Downloaded cached database from S3.")
-                with open(db, "wb") as cache_fd:
-                    cache_fd.write(cache_s3)
                 return self.database
             self.log.info("Cached database not found on S3.")
         """
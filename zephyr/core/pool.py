@@ -0,0 +1,158 @@
+import configparser
+import logging
+import os
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from . import sessions
+from .aws import uploader
+from .book import Book
+
+EMPTY = "empty"
+FAILED = "failed"
+REPORTED = "reported"
+SKIPPED = "skipped"
+STATUSES = (REPORTED, EMPTY, SKIPPED, FAILED)
+
+
+class Summary(object):
+    """Collect the outcome of a report for each account in a run."""
+    def __init__(self, statuses=STATUSES):
+        self.limits = dict()
+        self.results = list()
+        self.statuses = statuses
+
+    def add(self, account, status, message=""):
+        self.results.append((account, status, message))
+
+    def add_limits(self, pid, stats):
+        """Keep the latest rate limiter stats reported by each process."""
+        self.limits[pid] = stats
+
+    def combined_limits(self):
+        """Sum the stats of each backend over the processes of a run."""
+        out = dict()
+        for stats in self.limits.values():
+            for backend, stat in stats.items():
+                total = out.setdefault(backend, dict.fromkeys(stat, 0))
+                for key, value in stat.items():
+                    total[key] += value
+        return out
+
+    def count(self, status):
+        return len([
+            result for result in self.results if result[1] == status
+        ])
+
+    def failures(self):
+        return [result for result in self.results if result[1] == FAILED]
+
+    def log_to(self, log):
+        log.info("Summary: {}.".format(", ".join([
+            "{} {}".format(self.count(status), status)
+            for status in self.statuses
+        ])))
+        for line in sessions.format_stats(self.combined_limits()):
+            log.info(line)
+        for account, status, message in self.failures():
+            log.error("{account}: {message}".format(
+                account=account, message=message
+            ))
+
+
+def config_from_dict(config_dict):
+    config = configparser.RawConfigParser()
+    config.read_dict(config_dict)
+    return config
+
+
+def config_to_dict(config):
+    """Flatten a Cement configuration so that it can be sent to a worker."""
+    return {
+        section: config.get_section_dict(section)
+        for section in config.get_sections()
+    }
+
+
+def get_worker_log():
+    """
+    Workers cannot share the Cement log handler, but forked workers inherit
+    its backend so we log there with the namespace Cement expects.
+    """
+    return logging.LoggerAdapter(
+        logging.getLogger("cement:app:zephyr"),
+        dict(namespace="zephyr"),
+    )
+
+
+def run_account(config_dict, label, sheets, account, date, expire_cache):
+    """
+    Build and write one book. Each worker owns its clients and sessions.
+    Return the account, its status, a message and the rate limiter stats of
+    the worker.
+    """
+    return _run_account(
+        config_dict, label, sheets, account, date, expire_cache
+    ) + ((os.getpid(), sessions.limiter_stats()),)
+
+
+def _run_account(config_dict, label, sheets, account, date, expire_cache):
+    config = config_from_dict(config_dict)
+    log = get_worker_log()
+    try:
+        book = Book(
+            config,
+            label,
+            sheets,
+            account,
+            date,
+            expire_cache,
+            log=log,
+        )
+        if not book.slug_valid(account):
+            return account, SKIPPED, "Configuration is missing for {}.".format(
+                book.missing_validators(account)
+            )
+        log.info("Running {report} for {account}".format(
+            report=label,
+            account=account,
+        ))
+        out = book.to_xlsx()
+        if not any(bool(value) for value in out.values()):
+            return account, EMPTY, "No data to report."
+        return account, REPORTED, book.filename
+    except Exception as e:
+        return account, FAILED, "{}: {}".format(type(e).__name__, e)
+    finally:
+        # Pool workers do not run exit handlers, so finish uploads here.
+        uploader.drain_all()
+
+
+def run_accounts(
+    config, log, label, sheets, accounts, date, expire_cache, workers
+):
+    """Run a report for each account across a pool of worker processes."""
+    config_dict = config_to_dict(config)
+    summary = Summary()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                run_account,
+                config_dict,
+                label,
+                sheets,
+                account,
+                date,
+                expire_cache,
+            )
+            for account in accounts
+        ]
+        for future in as_completed(futures):
+            account, status, message, limits = future.result()
+            log.info("Finished {account}: {status}.".format(
+                account=account, status=status
+            ))
+            summary.add(account, status, message)
+            summary.add_limits(*limits)
+    summary.log_to(log)
+    return summary
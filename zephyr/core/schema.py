@@ -0,0 +1,117 @@
+import json
+import sqlite3
+
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+from .utils import from_isoformat
+
+DECIMAL = "decimal"
+INTEGER = "integer"
+JSON = "json"
+MONEY = "money"
+PERCENT = "percent"
+REAL = "real"
+TEXT = "text"
+TIMESTAMP = "timestamp"
+
+# Declared types name converters of zephyr's own, which only connections
+# made by connect apply. Their last word gives the column its affinity, so
+# decimals are stored as REAL and sort and sum as numbers in SQL.
+SQL_TYPES = {
+    DECIMAL: "ZEPHYR_DECIMAL REAL",
+    INTEGER: "INTEGER",
+    JSON: "ZEPHYR_JSON TEXT",
+    MONEY: "ZEPHYR_DECIMAL REAL",
+    PERCENT: "ZEPHYR_DECIMAL REAL",
+    REAL: "REAL",
+    TEXT: "TEXT",
+    TIMESTAMP: "ZEPHYR_TIMESTAMP TEXT",
+}
+
+# How values of a type are bound, when sqlite3 cannot bind them natively.
+ADAPTERS = {
+    DECIMAL: float,
+    JSON: json.dumps,
+    MONEY: float,
+    PERCENT: float,
+    TIMESTAMP: datetime.isoformat,
+}
+
+
+def adapt(value, adapter):
+    if value is None or isinstance(value, str):
+        return value
+    return adapter(value)
+
+
+def adapt_row(row, adapters):
+    row = list(row)
+    for i, adapter in adapters:
+        row[i] = adapt(row[i], adapter)
+    return row
+
+
+def connect(database=":memory:"):
+    """Connect to a database which reads typed columns back as declared."""
+    return sqlite3.connect(database, detect_types=sqlite3.PARSE_DECLTYPES)
+
+
+def load(con, name, header, rows, types=None):
+    """
+    Replace a table with rows in one executemany. Values are bound natively,
+    so numbers stay numbers; columns without a type are stored as they are.
+    """
+    types = types or dict()
+    columns = ", ".join(
+        '"{}" {}'.format(column, SQL_TYPES.get(types.get(column), ""))
+        for column in header
+    )
+    adapters = [
+        (i, ADAPTERS[types[column]])
+        for i, column in enumerate(header)
+        if types.get(column) in ADAPTERS
+    ]
+    if adapters:
+        rows = (adapt_row(row, adapters) for row in rows)
+    con.execute('DROP TABLE IF EXISTS "{}"'.format(name))
+    con.execute('CREATE TABLE "{}" ({})'.format(name, columns))
+    con.executemany(
+        'INSERT INTO "{}" VALUES ({})'.format(
+            name, ", ".join("?" * len(header))
+        ),
+        rows,
+    )
+
+
+def to_decimal(value):
+    # Decimals are read back from the shortest text of their REAL. Values
+    # which did not parse as numbers were stored as they came.
+    try:
+        return Decimal(value.decode())
+    except InvalidOperation:
+        return value.decode()
+
+
+def to_json(value):
+    # Python 3.5 cannot load JSON from bytes.
+    return json.loads(value.decode())
+
+
+def to_timestamp(value):
+    try:
+        return from_isoformat(value.decode())
+    except ValueError:
+        return value.decode()
+
+
+CONVERTERS = {
+    "ZEPHYR_DECIMAL": to_decimal,
+    "ZEPHYR_JSON": to_json,
+    "ZEPHYR_TIMESTAMP": to_timestamp,
+}
+
+# Converters are registered process wide. Only the types of tables which load
+# creates name them, so other connections never use them.
+for name, converter in CONVERTERS.items():
+    sqlite3.register_converter(name, converter)
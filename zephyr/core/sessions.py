@@ -0,0 +1,235 @@
+import email.utils
+import os
+import random
+import threading
+import time
+
+import requests
+
+from requests.adapters import HTTPAdapter
+
+BACKOFF = 1
+MAX_BACKOFF = 60
+POOL_SIZE = 16
+RETRIES = 5
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+THROTTLE_STATUSES = (429, 503)
+# Connect and read timeouts. Large CloudCheckr pages take minutes to build.
+TIMEOUT = (10, 300)
+
+# Requests per second. The rate grows by RATE_INCREASE after each healthy
+# response, halves when throttled and shrinks when latency spikes above
+# SPIKE_FACTOR times its moving average.
+RATE = 5
+RATE_BURST = 5
+RATE_INCREASE = 0.1
+RATE_MAX = 50
+RATE_MIN = 0.2
+SLOW_FACTOR = 0.8
+SPIKE_FACTOR = 3
+SPIKE_WARMUP = 5
+THROTTLE_FACTOR = 0.5
+LATENCY_WEIGHT = 0.2
+
+_lock = threading.Lock()
+_limiters = dict()
+_sessions = dict()
+
+
+def backoff(attempt, response=None):
+    """
+    Seconds to wait before the next attempt. Honour Retry-After when the
+    server sends one, otherwise back off exponentially with full jitter so
+    that concurrent requests do not retry in step.
+    """
+    if response is not None:
+        retry_after = get_retry_after(response)
+        if retry_after is not None:
+            return min(retry_after, MAX_BACKOFF)
+    return random.uniform(0, min(BACKOFF * 2**attempt, MAX_BACKOFF))
+
+
+def format_stats(stats):
+    """Describe the limiter of each backend in a line of the run summary."""
+    return [
+        "{backend}: {requests} requests, {throttled} throttled, "
+        "{slow} slow, {errors} errors, {rate:.1f} requests/s allowed."
+        .format(backend=backend, **stat)
+        for backend, stat in sorted(stats.items())
+    ]
+
+
+def get(session, url, log=None, retries=RETRIES, limiter=None, **kwargs):
+    """
+    GET a url, retrying connection errors, 429 and 5xx responses. The last
+    response is returned even if it failed, so callers still check it. A
+    limiter paces each attempt and learns from its outcome.
+    """
+    kwargs.setdefault("timeout", TIMEOUT)
+    for attempt in range(retries + 1):
+        response = None
+        if limiter:
+            limiter.acquire()
+        start = time.monotonic()
+        try:
+            response = session.get(url, **kwargs)
+            if limiter:
+                limiter.record(response.status_code, time.monotonic() - start)
+            if response.status_code not in RETRY_STATUSES:
+                return response
+            reason = "got code {}".format(response.status_code)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if limiter:
+                limiter.record(None, time.monotonic() - start)
+            if attempt == retries:
+                raise
+            reason = type(e).__name__
+        if attempt == retries:
+            return response
+        wait = backoff(attempt, response)
+        if log:
+            log("Request failed, {reason}. Retrying in {wait:.1f}s.".format(
+                reason=reason, wait=wait
+            ))
+        time.sleep(wait)
+
+
+def get_limiter(backend):
+    """Get the rate limiter shared by the requests of a backend."""
+    key = (backend, os.getpid())
+    with _lock:
+        if key not in _limiters:
+            _limiters[key] = Limiter()
+        return _limiters[key]
+
+
+def get_retry_after(response):
+    """Seconds from a Retry-After header, given as a delay or a date."""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(date.timestamp() - time.time(), 0)
+
+
+def get_session(backend):
+    """
+    Get the HTTP session of this process for a backend. Sessions keep their
+    connections alive, so pages and calls reuse them instead of opening a
+    new TLS connection per request. Forked workers build their own.
+    """
+    key = (backend, os.getpid())
+    with _lock:
+        if key not in _sessions:
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({"Accept-Encoding": "gzip, deflate"})
+            _sessions[key] = session
+        return _sessions[key]
+
+
+def limiter_stats():
+    """The state of the limiters of this process by backend."""
+    pid = os.getpid()
+    return {
+        backend: limiter.stats()
+        for (backend, owner), limiter in list(_limiters.items())
+        if owner == pid
+    }
+
+
+class Limiter(object):
+    """
+    A token bucket shared by the requests of one backend in a process. Its
+    rate adapts AIMD style: it grows additively while responses are healthy
+    and is cut multiplicatively on throttling, errors and latency spikes, so
+    requests run near the highest rate the API tolerates.
+    """
+    def __init__(
+        self,
+        rate=RATE,
+        burst=RATE_BURST,
+        max_rate=RATE_MAX,
+        min_rate=RATE_MIN,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.burst = burst
+        self.clock = clock
+        self.errors = 0
+        self.latency = None
+        self.lock = threading.Lock()
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = rate
+        self.requests = 0
+        self.sleep = sleep
+        self.slow = 0
+        self.throttled = 0
+        self.tokens = burst
+        self.updated = clock()
+
+    def acquire(self):
+        """Block until the bucket holds a token, then take it."""
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+    def decrease(self, factor):
+        self.rate = max(self.min_rate, self.rate * factor)
+
+    def record(self, status, elapsed):
+        """Adapt the rate to a response, or to a failed request if None."""
+        with self.lock:
+            self.requests += 1
+            if status in THROTTLE_STATUSES:
+                self.throttled += 1
+                self.decrease(THROTTLE_FACTOR)
+                return
+            if status is None or status >= 500:
+                self.errors += 1
+                self.decrease(THROTTLE_FACTOR)
+                return
+            spike = (
+                self.requests > SPIKE_WARMUP
+                and self.latency is not None
+                and elapsed > SPIKE_FACTOR * self.latency
+            )
+            if self.latency is None:
+                self.latency = elapsed
+            self.latency += LATENCY_WEIGHT * (elapsed - self.latency)
+            if spike:
+                self.slow += 1
+                self.decrease(SLOW_FACTOR)
+                return
+            self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                errors=self.errors,
+                rate=self.rate,
+                requests=self.requests,
+                slow=self.slow,
+                throttled=self.throttled,
+            )
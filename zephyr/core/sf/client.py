@@ -25,20 +25,11 @@ class SalesForce(Client):
         return self._sf
 
     def get_account_by_slug(self, slug):
-        matches = pd.read_sql("""
-            SELECT a.name AS client
-            FROM
-                sf_accounts AS a LEFT OUTER JOIN
-                sf_projects AS p ON (a.Id=p.Account__c) LEFT OUTER JOIN
-                sf_aws AS aws ON (p.Id=aws.Assoc_Project__c)
-            WHERE aws.name = '{slug}'
-            """.format(slug=slug),
-            self.database
-        )
-        if not len(matches):
+        account = self.get_account(slug)
+        if account is None or account.client is None:
             self.log.error("There are no projects associated with this slug.")
             return slug
-        return matches["client"][0]
+        return account.client
 
     def get_session(self, username, password, token):
         return Salesforce(
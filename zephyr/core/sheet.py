@@ -1,11 +1,19 @@
 import datetime
-import pandas as pd
-import sqlite3
+import weakref
 
-from ..core.client import Client
+from decimal import Decimal
+from itertools import count
+
+from ..core.client import Client, Registry
 from ..core.sf import client as sf
+from . import aggregate, schema
 from .ddh import DDH
 
+NUMBERS = (Decimal, float, int)
+NUMBER_TYPES = (
+    schema.DECIMAL, schema.INTEGER, schema.MONEY, schema.PERCENT, schema.REAL
+)
+
 FORMATTING = {
     "cell_options": {
         "height": 20,
@@ -15,6 +23,9 @@ FORMATTING = {
         "height": 288,
         "width": 480,
     },
+    "date_format": {
+        "num_format": "mm/dd/yy hh:mm",
+    },
     "data_labels": {
         "category": True,
         "percentage": True,
@@ -42,27 +53,49 @@ FORMATTING = {
     },
 }
 
+# The date format of each workbook, shared by all of its sheets and tables.
+_date_formats = weakref.WeakKeyDictionary()
+
 
 class Sheet(Client):
     formatting = FORMATTING
     name = None
     title = None
+    # Cleaners of columns by index, each called on every value of its column.
     clean = dict()
+    # The group-bys of the charts, computed together in a single scan.
+    group_bys = ()
 
     def __init__(
-        self, config, account=None, date=None, expire_cache=None, log=None
+        self,
+        config,
+        account=None,
+        date=None,
+        expire_cache=None,
+        log=None,
+        registry=None,
     ):
         super().__init__(config, log=log)
+        self._aggregates = dict()
         self.account = account
-        self.con = sqlite3.connect(":memory:")
+        self.registry = registry or Registry(config, log=log)
+        self.con = self.registry.con
         self.date = date
         self.expire_cache = expire_cache
         self.get_formatting()
         self.sheet = None
         self.table_left = int(self.chart_width) + self.cell_spacing
-        self.clients = tuple(
-            [Call(config=config, log=log) for Call in self.calls]
-        )
+        self.clients = tuple([
+            self.registry.client(Call, account, date) for Call in self.calls
+        ])
+
+    @property
+    def types(self):
+        """The schema types of the columns, as the calls declare them."""
+        types = dict()
+        for client in self.clients:
+            types.update(client.types)
+        return types
 
     @property
     def ddh(self):
@@ -72,6 +105,15 @@ class Sheet(Client):
         self._ddh = self.to_ddh()
         return self._ddh
 
+    def apply_clean(self, rows):
+        """Copy rows, passing each value of a cleaned column through it."""
+        data = [list(row) for row in rows]
+        for index, clean in self.clean.items():
+            column = map(clean, [row[index] for row in data])
+            for row, value in zip(data, column):
+                row[index] = value
+        return data
+
     def book_formats(self):
         """Get format objects from book."""
         table = self.formatting["table_style"]
@@ -79,24 +121,64 @@ class Sheet(Client):
         cell_format = self.book.add_format(self.formatting["label_format"])
         return table, header_format, cell_format
 
+    def aggregate(self, group_by):
+        """
+        Get the header and data of a group-by of the sheet. The first call
+        computes it along with every other group-by of the sheet.
+        """
+        if group_by not in self._aggregates:
+            group_bys = [group_by] + [
+                other for other in self.group_bys
+                if other != group_by and other not in self._aggregates
+            ]
+            self._aggregates.update(aggregate.run(
+                self.ddh.header, self.ddh.data, group_bys
+            ))
+        return self._aggregates[group_by]
+
     def count_by(self, column):
         """Count rows in data grouping by values in the column specified"""
-        con = sqlite3.connect(":memory:")
-        df = pd.DataFrame(self.ddh.data, columns=self.ddh.header)
-        df.to_sql("df", con, if_exists="replace")
-        query = """
-            SELECT
-                 {col},
-                 COUNT({col}) as Total
-             FROM df
-             GROUP BY {col}
-             ORDER BY COUNT({col}) DESC
-        """.format(col=column)
-        sql_group = pd.read_sql(query, con)
-        header = list(sql_group)
-        data = [list(row) for row in sql_group.values]
-
-        return header, data
+        return self.aggregate(aggregate.count_by(column))
+
+    def column_writers(self, rows, types=None):
+        """
+        Pick the xlsxwriter method of each column from its schema type, or
+        from the first value of the column which is not empty when it has
+        none. Values of the expected type skip write()'s dispatch; others
+        still go through it. Only declared text columns skip the
+        strings_to_numbers conversion.
+        """
+        width = len(rows[0])
+        types = types or [None] * width
+        row = [None] * width
+        # Only the columns without a type are inferred from their values.
+        missing = {j for j, kind in enumerate(types) if kind is None}
+        for values in rows:
+            if not missing:
+                break
+            for j in list(missing):
+                if values[j] is not None and values[j] != "":
+                    row[j] = values[j]
+                    missing.discard(j)
+        writers = list()
+        for kind, value in zip(types, row):
+            if kind in NUMBER_TYPES or (
+                kind is None and type(value) in NUMBERS
+            ):
+                writers.append((self.sheet.write_number, NUMBERS, None))
+            elif kind == schema.TIMESTAMP or isinstance(
+                value, datetime.datetime
+            ):
+                writers.append((
+                    self.sheet.write_datetime,
+                    (datetime.datetime,),
+                    self.date_format(),
+                ))
+            elif kind == schema.TEXT:
+                writers.append((self.sheet.write_string, (str,), None))
+            else:
+                writers.append((None, (), None))
+        return writers
 
     def count_by_pie_chart(
         self, column_name, top, left, name
@@ -129,6 +211,14 @@ class Sheet(Client):
         self.put_chart(column_name, top, left, table_loc, "pie")
         return self.book
 
+    def date_format(self):
+        """Get the date format of the book, added to it only once."""
+        if self.book not in _date_formats:
+            _date_formats[self.book] = self.book.add_format(
+                self.formatting["date_format"]
+            )
+        return _date_formats[self.book]
+
     def get_formatting(self):
         self.cell = self.formatting["cell_options"]
         self.chart = self.formatting["chart_options"]
@@ -148,18 +238,16 @@ class Sheet(Client):
     def load_data(self):
         client_data = list()
         for client in self.clients:
-            response = client.cache_policy(
-                self.account, self.date, self.expire_cache
-            )
-            client.parse(response)
-            ddh = client.to_ddh()
+            ddh = client.load(self.account, self.date, self.expire_cache)
             client_data.append(bool(ddh) and bool(ddh.data))
-            data = [[str(cell) for cell in row] for row in ddh.data]
-            df = pd.DataFrame(data, columns=ddh.header)
-            df.to_sql(client.slug, self.con, if_exists='replace')
+            self.registry.to_sql(client)
 
         return all(client_data)
 
+    def prefetch_clients(self):
+        """The clients whose responses load_data reads from the cache."""
+        return self.clients
+
     def put_chart(
             self, title, top, left, data_loc, chart_type, formatting=None
     ):
@@ -206,7 +294,17 @@ class Sheet(Client):
         table_fmt, header_format, cell_format = self.book_formats()
 
         # Write data to sheet
-        self.sheet = self.rows_to_excel(ddh.data, top=top+1, left=left)
+        types = [self.types.get(column) for column in ddh.header]
+        if self.streaming:
+            # Tables are not supported in constant memory mode, so streamed
+            # data gets a plain header row, written before its rows.
+            self.sheet.write_row(top, left, ddh.header, header_format)
+            return self.rows_to_excel(
+                ddh.data, top=top+1, left=left, types=types
+            )
+        self.sheet = self.rows_to_excel(
+            ddh.data, top=top+1, left=left, types=types
+        )
 
         # Create format dict for xlsxwriter
         total_row = []
@@ -228,19 +326,29 @@ class Sheet(Client):
         )
         return self.sheet
 
-    def rows_to_excel(self, rows, top=1, left=0):
+    def rows_to_excel(self, rows, top=1, left=0, types=None):
         """
         Take rows, an iterable of iterables, and write it to a given sheet
-        with the top, left cell at (top, left).
+        with the top, left cell at (top, left). Each column is written with
+        the typed xlsxwriter method of its type hint, see column_writers.
         """
-        n_rows = len(rows)
-        n_cells = len(rows[0])
-        for i in range(n_rows):
-            row = rows[i]
-            for j in range(n_cells):
-                self.sheet.write(top+i, left+j, row[j])
+        writers = self.column_writers(rows, types)
+        write = self.sheet.write
+        for i, row in enumerate(rows, top):
+            for j, value, (write_typed, kinds, cell_format) in zip(
+                count(left), row, writers
+            ):
+                if type(value) in kinds:
+                    write_typed(i, j, value, cell_format)
+                else:
+                    write(i, j, value, cell_format)
         return self.sheet
 
+    @property
+    def streaming(self):
+        """Whether the book writes rows out as it goes, in row order."""
+        return bool(getattr(self.book, "constant_memory", False))
+
     def to_ddh(self):
         if(self._ddh):
             return self._ddh
@@ -250,10 +358,7 @@ class Sheet(Client):
         if(not client.ddh or not client.ddh.data):
             return False
         header = client.ddh.header
-        data = [[
-            self.clean.get(index, lambda x:x)(row[index])
-            for index in range(len(header))
-        ] for row in client.ddh.data]
+        data = self.apply_clean(client.ddh.data)
         ddh = DDH(header=header, data=data)
         self._ddh = ddh
         return self._ddh
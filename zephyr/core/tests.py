@@ -1,13 +1,32 @@
+import json
 import os
+import sqlite3
+import tempfile
+import threading
+import time
+import warnings
 
+import xlsxwriter
+
+from boto3.exceptions import RetriesExceededError
+from botocore.exceptions import ClientError, ReadTimeoutError
 from cement.utils import test
 from datetime import datetime
+from decimal import Decimal
 
 from ..cli.tests import TestZephyr, TestZephyrFixtures
+from . import accounts, aggregate, cache, pool, schema, sessions, warm
+from .client import Client
+from .aws import utils as aws
+from .aws.uploader import Uploader
 from .ddh import DDH
+from .manifest import Manifest
 
 from .dy.calls import Billing
+from .dy.sheets import SheetBilling
 from .lo.calls import ServiceRequests
+from .cc import bpc
+from .cc.client import CloudCheckr, CloudCheckrBPCs
 from .cc.calls import (
     ComputeDetails,
     ComputeMigration,
@@ -17,10 +36,880 @@ from .cc.calls import (
     DBIdle,
     IAMUsersData,
     LBIdle,
+    StaleDelta,
     StorageDetached,
 )
 from .cc.sheets import SheetComputeDetails, SheetComputeUnderutilized
-from .utils import first_of_previous_month
+from .utils import first_of_previous_month, ZephyrException
+
+
+class ZephyrTestCase(test.CementTestCase):
+    """A test case with the config and quiet log of a configured app."""
+    app_class = TestZephyr
+
+    def setUp(self):
+        super().setUp()
+        with self.app_class() as app:
+            app.configure()
+            app.log.set_level("ERROR")
+            self.config = app.config
+            self.log = app.log
+
+
+class TestZephyrCache(ZephyrTestCase):
+
+    def test_cache_round_trip(self):
+        response = '[{"HasNext": false}]'
+        blob = cache.encode(response)
+        assert cache.is_compressed(blob)
+        self.eq(cache.decode(blob), response)
+
+    def test_cache_uncompressed(self):
+        response = '[{"HasNext": false}]'
+        self.eq(cache.decode(response.encode("utf-8")), response)
+
+    def test_cache_compress_file(self):
+        response = '[{"HasNext": false}]'
+        with tempfile.TemporaryDirectory() as cache_root:
+            path = os.path.join(cache_root, "compute-details.json")
+            with open(path, "w") as f:
+                f.write(response)
+            self.eq(list(cache.entries(cache_root)), [path])
+            self.eq(cache.compress_file(path), True)
+            self.eq(cache.compress_file(path), False)
+            self.eq(cache.read(path), response)
+
+    def test_cache_evict(self):
+        with tempfile.TemporaryDirectory() as cache_root:
+            keys = ["old.json", "recent.json", "pinned.json"]
+            for key in keys:
+                with open(os.path.join(cache_root, key), "wb") as f:
+                    f.write(b"0" * 100)
+            accessed = {"old.json": 1, "recent.json": 2, "pinned.json": 0}
+            for key, used in accessed.items():
+                os.utime(os.path.join(cache_root, key), (used, used))
+            pinned = lambda key: key == "pinned.json"
+            # An entry being fetched is skipped until its lock is released.
+            with cache.lock(os.path.join(cache_root, "old.json")):
+                self.eq(cache.evict(
+                    cache_root, 200, accessed, lambda key: key != "old.json"
+                ), [])
+            evicted = cache.evict(cache_root, 200, accessed, pinned)
+            self.eq(evicted, ["old.json"])
+            self.eq(
+                sorted(os.listdir(cache_root)),
+                ["old.json.lock", "pinned.json", "recent.json"],
+            )
+
+    def test_clear_cache_local_month(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache_root = os.path.join(tmp, "cache")
+            self.config.set("zephyr", "ZEPHYR_CACHE_ROOT", cache_root)
+            client = Client(self.config, log=self.log)
+            # Nothing is cached yet, so there is nothing to clear.
+            client.clear_cache_local_month("2001-01")
+            for account in ("a", "b"):
+                os.makedirs(os.path.join(cache_root, account, "2001-02"))
+            os.makedirs(os.path.join(cache_root, "a", "2001-01"))
+            client.clear_cache_local_month("2001-01")
+            client.clear_cache_local("b", "2001-01")
+            self.eq(os.listdir(os.path.join(cache_root, "a")), ["2001-02"])
+
+
+class SlowCall(Client):
+    name = "Test"
+    slug = "slow"
+    requests = []
+
+    def request(self, account, date):
+        self.requests.append(account)
+        time.sleep(0.2)
+        return "[]"
+
+
+class ParsedCall(SlowCall):
+    slug = "parsed"
+    header = ("Value",)
+    requests = []
+
+    def parse(self, response):
+        self.data = json.loads(response)
+
+
+class TestZephyrCacheLock(ZephyrTestCase):
+
+    def test_cache_stampede(self):
+        responses = []
+        with tempfile.TemporaryDirectory() as cache_root:
+            def fetch():
+                client = SlowCall(self.config, log=self.log)
+                client.ZEPHYR_CACHE_ROOT = cache_root
+                responses.append(client.cache_policy("acct", "2001-01-01", None))
+            threads = [threading.Thread(target=fetch) for i in range(3)]
+            [thread.start() for thread in threads]
+            [thread.join() for thread in threads]
+            month = os.path.join(cache_root, "acct", "2001-01")
+            self.eq(sorted(os.listdir(month)), ["slow.json", "slow.json.lock"])
+        self.eq(SlowCall.requests, ["acct"])
+        self.eq(responses, ["[]"]*3)
+
+    def test_load_drops_response(self):
+        with tempfile.TemporaryDirectory() as cache_root:
+            client = ParsedCall(self.config, log=self.log)
+            client.ZEPHYR_CACHE_ROOT = cache_root
+            self.eq(client.load("acct", "2001-01-01", None).data, [])
+        self.eq(client.response, None)
+
+
+class WarmCall(SlowCall):
+    slug = "warm"
+    requests = []
+
+    def get_account_by_slug(self, slug):
+        return slug != "unknown"
+
+
+class OtherWarmCall(WarmCall):
+    name = "Other"
+    slug = "other"
+    requests = []
+
+
+class TestZephyrCacheWarm(ZephyrTestCase):
+
+    def test_warm_calls(self):
+        sheets = (SheetBilling, SheetComputeDetails)
+        self.eq(warm.get_calls(sheets, slugs=["billing"]), [Billing])
+        with self.assertRaises(ZephyrException):
+            warm.get_calls(sheets, slugs=["billing", "nonexistent"])
+
+    def test_warm(self):
+        config_dict = pool.config_to_dict(self.config)
+        with tempfile.TemporaryDirectory() as cache_root:
+            config_dict["zephyr"]["zephyr_cache_root"] = cache_root
+            config = pool.config_from_dict(config_dict)
+            warmer = warm.Warmer(config, (WarmCall, OtherWarmCall), log=self.log)
+            summary = warmer.warm(["a", "b", "unknown"], "2001-01-01")
+            self.eq(summary.count(warm.FETCHED), 4)
+            self.eq(summary.count(pool.SKIPPED), 2)
+            summary = warmer.warm(["a", "b"], "2001-01-01")
+            self.eq(summary.count(warm.CACHED), 4)
+        self.eq(sorted(WarmCall.requests), ["a", "b"])
+        self.eq(sorted(OtherWarmCall.requests), ["a", "b"])
+
+
+class StubResponse(object):
+    def __init__(self, status_code, headers=None, body=None):
+        self.body = body
+        self.headers = headers or dict()
+        self.status_code = status_code
+
+    def json(self):
+        return self.body
+
+
+class StubSession(object):
+    """Answer each GET with the next of the given responses."""
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.urls = []
+
+    def get(self, url, timeout=None):
+        self.urls.append(url)
+        return self.responses.pop(0)
+
+
+class TestZephyrSessions(test.CementTestCase):
+
+    def test_session_shared(self):
+        session = sessions.get_session("CloudCheckr")
+        self.eq(session is sessions.get_session("CloudCheckr"), True)
+        self.eq(session is sessions.get_session("Logicops"), False)
+        self.eq("gzip" in session.headers["Accept-Encoding"], True)
+
+    def test_retry_after(self):
+        session = StubSession([
+            StubResponse(503),
+            StubResponse(429, {"Retry-After": "0"}),
+            StubResponse(200),
+        ])
+        sessions.BACKOFF, backoff = 0, sessions.BACKOFF
+        try:
+            response = sessions.get(session, "url")
+        finally:
+            sessions.BACKOFF = backoff
+        self.eq(response.status_code, 200)
+        self.eq(len(session.urls), 3)
+
+    def test_retries_exhausted(self):
+        session = StubSession([StubResponse(500, {"Retry-After": "0"})] * 2)
+        response = sessions.get(session, "url", retries=1)
+        self.eq(response.status_code, 500)
+
+    def test_no_retry(self):
+        session = StubSession([StubResponse(404)])
+        self.eq(sessions.get(session, "url").status_code, 404)
+
+
+class TestZephyrLimiter(test.CementTestCase):
+
+    def test_limiter_paces(self):
+        now = [0.0]
+        sleeps = []
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+        limiter = sessions.Limiter(
+            rate=2, burst=1, clock=lambda: now[0], sleep=sleep
+        )
+        limiter.acquire()
+        limiter.acquire()
+        self.eq(sleeps, [0.5])
+
+    def test_limiter_aimd(self):
+        limiter = sessions.Limiter(rate=4)
+        limiter.record(200, 1)
+        self.eq(limiter.rate, 4 + sessions.RATE_INCREASE)
+        limiter.record(429, 1)
+        self.eq(limiter.rate, (4 + sessions.RATE_INCREASE) / 2)
+        for i in range(sessions.SPIKE_WARMUP):
+            limiter.record(200, 1)
+        rate = limiter.rate
+        limiter.record(200, 10)
+        self.eq(limiter.rate, rate * sessions.SLOW_FACTOR)
+        stats = limiter.stats()
+        self.eq((stats["throttled"], stats["slow"]), (1, 1))
+
+    def test_summary_limits(self):
+        summary = pool.Summary()
+        stats = dict(errors=0, rate=1.0, requests=2, slow=0, throttled=1)
+        summary.add_limits(1, dict(CloudCheckr=stats))
+        summary.add_limits(2, dict(CloudCheckr=stats))
+        self.eq(summary.combined_limits()["CloudCheckr"]["requests"], 4)
+
+
+class PagedCall(CloudCheckr):
+    slug = "paged"
+    session = None
+
+
+class TestZephyrPages(test.CementTestCase):
+
+    def test_store_pages_resume(self):
+        pages = [
+            dict(HasNext=True, NextToken="t1", Items=[1]),
+            dict(HasNext=True, NextToken="t2", Items=[2]),
+            dict(HasNext=False, Items=[3]),
+        ]
+        client = PagedCall()
+        log = lambda message: None
+        with tempfile.TemporaryDirectory() as cache_root:
+            path = os.path.join(cache_root, "paged.json.partial")
+            client.session = StubSession([
+                StubResponse(200, body=pages[0]), StubResponse(404),
+            ])
+            with self.assertRaises(ZephyrException):
+                client.store_pages("url", path, log=log)
+            client.session = StubSession([
+                StubResponse(200, body=page) for page in pages[1:]
+            ])
+            client.store_pages("url", path, log=log)
+            self.eq(client.session.urls, [
+                "url&next_token=t1", "url&next_token=t2",
+            ])
+            with open(path, "r") as f:
+                self.eq(list(client.get_pages(f.read())), pages)
+            client.store_pages("url", path, log=log)
+            self.eq(len(client.session.urls), 2)
+
+    def test_get_pages_list(self):
+        pages = [dict(HasNext=False, Items=[])]
+        self.eq(list(PagedCall().get_pages(json.dumps(pages))), pages)
+
+    def test_get_pages_stored(self):
+        pages = [dict(HasNext=True, Items=[1]), dict(HasNext=False, Items=[])]
+        with tempfile.TemporaryDirectory() as cache_root:
+            path = os.path.join(cache_root, "paged.json")
+            cache.write(path, "\n".join(json.dumps(page) for page in pages))
+            stored = cache.Stored(path)
+            self.eq(list(PagedCall().get_pages(stored)), pages)
+            # Each read starts over from the top of the file.
+            self.eq(list(PagedCall().get_pages(stored)), pages)
+            with open(path, "w") as f:
+                f.write(json.dumps(pages, indent=1))
+            self.eq(list(PagedCall().get_pages(stored)), pages)
+
+    def test_merge_pages(self):
+        pages = [dict(Items=[1, 2]), dict(Items=[]), dict(Items=[3])]
+        client = PagedCall()
+        client._items_from_pages = lambda page: page["Items"]
+        self.eq(list(client.merge(iter(pages))), [1, 2, 3])
+
+    def test_project_items(self):
+        tag = dict(Key="lw:environment", Value="prod", InstanceId="i-2")
+        item = dict(
+            InstanceId="i-1", LaunchTime="2017-01-01T00:00:00",
+            ResourceTags=[tag], AvgCpuforLast7Days=1.0,
+        )
+        page = dict(HasNext=False, Ec2Instances=[item])
+        client = ComputeDetails(all_tags=True)
+        client.parse(json.dumps(page))
+        row = dict(zip(client.header, client.data[0]))
+        self.eq(row["ResourceTags"], [tag])
+        self.eq(row["Environment"], "prod")
+        self.eq(row["LaunchTime"], datetime(2017, 1, 1))
+        self.eq("AvgCpuforLast7Days" in client.project(item), False)
+
+
+class TestZephyrBPC(test.CementTestCase):
+
+    def test_bpc_typed_row(self):
+        client = ComputeUnderutilized()
+        row = client.row(
+            "Instance: i-0123 (web) | Average CPU Util: 1.5% | "
+            "Predicted Monthly Cost: $1,024.50 | Region: US East"
+        )
+        self.eq(row, [
+            "i-0123", "web", Decimal("1.5"), Decimal("1024.50"), "US East"
+        ])
+
+    def test_bpc_unparseable(self):
+        self.eq(bpc.to_decimal("N/A"), None)
+        self.eq(bpc.to_integer("N/A"), None)
+        self.eq(bpc.to_integer("2"), 2)
+        self.eq(bpc.parse_instance("i-0123"), ("i-0123", ""))
+
+    def test_bpc_unparseable_sum(self):
+        client = ComputeUnderutilized()
+        data = [
+            client.row(
+                "Instance: i-{} | Average CPU Util: 1% | "
+                "Predicted Monthly Cost: {} | Region: US East".format(n, cost)
+            )
+            for n, cost in enumerate(("$10.00", "N/A", "$2.50"))
+        ]
+        self.eq(data[1][3], None)
+        cost = aggregate.GroupBy("Region", (
+            aggregate.Aggregate(
+                "Cost", aggregate.SUM, "Predicted Monthly Cost"
+            ),
+        ))
+        header = list(client.header)
+        self.eq(
+            aggregate.run(header, data, (cost,))[cost][1],
+            [["US East", Decimal("12.50")]],
+        )
+        by_instance = aggregate.GroupBy("Instance ID", cost.aggregates)
+        self.eq(
+            aggregate.top(
+                by_instance.header,
+                aggregate.run(header, data, (by_instance,))[by_instance][1],
+                1,
+            ),
+            [["i-0", Decimal("10.00")], ["Other", Decimal("2.50")]],
+        )
+
+
+class StubBPCs(CloudCheckrBPCs):
+    """Answer with given pages of all best practice checks."""
+    def __init__(self, pages, **kwargs):
+        super().__init__(**kwargs)
+        self.pages = pages
+
+    def get_url(self, account, date):
+        return "url"
+
+    def iter_pages(self, url, token="", timing=False, log=print):
+        yield from self.pages
+
+
+class TestZephyrBPCs(ZephyrTestCase):
+
+    def test_fill_checks(self):
+        ri = "Number: {} | Instance Type: c3.large | AZ: us-east-1a | " \
+            "Platform: LinuxVpc | Commitment Type: 1 Year | " \
+            "Tenancy: Default | Upfront RI Cost: $1.00 | " \
+            "Reserved Monthly Cost: $1.00 | On-Demand Monthly Cost: $2.00 | " \
+            "Total Savings: $3.00"
+        idle = "DB Instance: db | Average Read IOPS: 0.34 | " \
+            "Average Write IOPS: 1.40 | Predicted Monthly Cost: $136.80 | " \
+            "Region: US East"
+        pages = [
+            dict(HasNext=True, NextToken="t", BestPracticeChecks=[
+                dict(CheckId=190, Results=[ri.format(1)]),
+                dict(CheckId=134, Results=[idle]),
+                dict(CheckId=999, Results=["Other: check"]),
+            ]),
+            dict(HasNext=False, BestPracticeChecks=[
+                dict(CheckId=190, Results=[ri.format(2)]),
+            ]),
+        ]
+        with tempfile.TemporaryDirectory() as cache_root:
+            clients = [
+                Call(config=self.config, log=self.log)
+                for Call in (ComputeRI, DBIdle, LBIdle)
+            ]
+            fetcher = StubBPCs(pages, config=self.config, log=self.log)
+            for client in clients + [fetcher]:
+                client.ZEPHYR_CACHE_ROOT = cache_root
+            filled = fetcher.fill_checks(clients, "acct", "2001-01-01")
+            self.eq(filled, clients[:2])
+            month = os.path.join(cache_root, "acct", "2001-01")
+            self.eq(
+                sorted(name for name in os.listdir(month)
+                    if name.endswith(".json")),
+                ["compute-ri.json", "db-idle.json"]
+            )
+            ri_client, idle_client = filled
+            ri_client.parse(cache.read(os.path.join(month, "compute-ri.json")))
+            self.eq([row[0] for row in ri_client.data], [1, 2])
+            idle_client.parse(idle_client.response)
+            self.eq(len(idle_client.data), 1)
+
+
+class TestZephyrAggregate(test.CementTestCase):
+
+    def test_single_scan(self):
+        header = ["Type", "Status", "Cost"]
+        data = [
+            ["t2", "running", 1.0],
+            ["m4", "running", 4.0],
+            ["t2", "stopped", 2.0],
+            ["c4", "running", None],
+            ["t2", "running", 3.0],
+        ]
+        running = aggregate.count_by(
+            "Type", where=("Status", aggregate.EQ, "running")
+        )
+        cost = aggregate.GroupBy("Type", (
+            aggregate.Aggregate("Count", aggregate.COUNT, "Cost"),
+            aggregate.Aggregate("Sum", aggregate.SUM, "Cost"),
+        ), order_by="Sum")
+        results = aggregate.run(header, data, (running, cost))
+        self.eq(results[running], (
+            ["Type", "Total"], [["t2", 2], ["m4", 1], ["c4", 1]],
+        ))
+        self.eq(results[cost][1], [
+            ["t2", 3, 6.0], ["m4", 1, 4.0], ["c4", 0, None],
+        ])
+        self.eq(
+            aggregate.top(["Type", "Total"], results[running][1], 1),
+            [["t2", 2], ["Other", 2]],
+        )
+
+    def test_where_nocase(self):
+        header = ["Line Item", "Subtotal"]
+        data = [
+            ["item", 1.0],
+            ["***Note", 2.0],
+            ["***NOTE", 4.0],
+        ]
+        items = aggregate.GroupBy(
+            "Line Item",
+            (aggregate.Aggregate("Total", aggregate.SUM, "Subtotal"),),
+            where=("Line Item", aggregate.NE_NOCASE, "***Note"),
+        )
+        notes = aggregate.GroupBy(
+            "Line Item",
+            (aggregate.Aggregate("Total", aggregate.SUM, "Subtotal"),),
+            where=("Line Item", aggregate.EQ_NOCASE, "***note"),
+        )
+        results = aggregate.run(header, data, (items, notes))
+        self.eq(results[items][1], [["item", 1.0]])
+        self.eq(results[notes][1], [["***NOTE", 4.0], ["***Note", 2.0]])
+
+
+class TestZephyrSchema(test.CementTestCase):
+
+    def test_load_typed(self):
+        header = ["Name", "Count", "Cost", "Tags"]
+        types = {
+            "Count": schema.INTEGER,
+            "Cost": schema.MONEY,
+            "Tags": schema.JSON,
+        }
+        rows = [
+            ["a", 1, Decimal("0.10"), [dict(Key="k", Value="v")]],
+            ["b", 2, Decimal("0.20"), []],
+            ["c", None, "N/A", None],
+        ]
+        con = schema.connect()
+        schema.load(con, "typed", header, rows, types)
+        self.eq(con.execute('SELECT * FROM "typed"').fetchall(), [
+            ("a", 1, Decimal("0.10"), [dict(Key="k", Value="v")]),
+            ("b", 2, Decimal("0.20"), []),
+            ("c", None, "N/A", None),
+        ])
+        self.eq(con.execute('SELECT SUM("Count") FROM "typed"').fetchone(), (3,))
+        # Decimals are stored as numbers, so they sort and sum as numbers.
+        schema.load(con, "costs", ["Cost"], [
+            [Decimal("9.5")], [Decimal("10.25")],
+        ], dict(Cost=schema.MONEY))
+        self.eq(con.execute(
+            'SELECT "Cost" FROM "costs" ORDER BY "Cost" DESC'
+        ).fetchall(), [(Decimal("10.25"),), (Decimal("9.5"),)])
+        self.eq(
+            con.execute('SELECT SUM("Cost") FROM "costs"').fetchone(),
+            (19.75,),
+        )
+        launched = [
+            datetime(2017, 1, 1, 2, 3, 4), datetime(2017, 1, 1, 0, 0, 0, 5),
+        ]
+        schema.load(
+            con, "times", ["Launched"], [[t] for t in launched],
+            dict(Launched=schema.TIMESTAMP),
+        )
+        self.eq(
+            [row[0] for row in con.execute('SELECT * FROM "times"')],
+            launched,
+        )
+        # Other connections do not use the converters.
+        other = sqlite3.connect(
+            ":memory:", detect_types=sqlite3.PARSE_DECLTYPES
+        )
+        other.execute("CREATE TABLE t (x DECIMAL)")
+        other.execute("INSERT INTO t VALUES ('1.5')")
+        self.eq(other.execute("SELECT x FROM t").fetchone(), (1.5,))
+
+
+class TestZephyrXlsx(ZephyrTestCase):
+
+    def test_rows_to_excel_types(self):
+        sheet = SheetComputeDetails(self.config, date="2017-03-01")
+        row = ["001", "002", Decimal("1.5"), datetime(2017, 1, 1), None]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "types.xlsx")
+            with xlsxwriter.Workbook(path, {"strings_to_numbers": True}) as book:
+                sheet.book = book
+                sheet.sheet = book.add_worksheet("types")
+                sheet.rows_to_excel(
+                    [row], top=0, types=[schema.TEXT, None, None, None, None]
+                )
+                cells = sheet.sheet.table[0]
+        self.eq(
+            [type(cells[j]).__name__ for j in range(3)],
+            ["String", "Number", "Number"],
+        )
+        self.eq(cells[3].format.num_format, "mm/dd/yy hh:mm")
+        self.eq(4 in cells, False)
+
+    def test_rows_to_excel_first_value(self):
+        sheet = SheetComputeDetails(self.config, date="2017-03-01")
+        rows = [
+            ["", None],
+            [Decimal("1.5"), datetime(2017, 1, 1)],
+        ]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "first.xlsx")
+            with xlsxwriter.Workbook(path) as book:
+                sheet.book = book
+                sheet.sheet = book.add_worksheet("first")
+                writers = sheet.column_writers(rows)
+                sheet.rows_to_excel(rows, top=0)
+                cells = sheet.sheet.table[1]
+        self.eq(
+            [writer.__name__ for writer, _, _ in writers],
+            ["write_number", "write_datetime"],
+        )
+        self.eq(type(cells[0]).__name__, "Number")
+        self.eq(cells[1].format.num_format, "mm/dd/yy hh:mm")
+
+    def test_date_format_once_per_book(self):
+        sheet = SheetComputeDetails(self.config, date="2017-03-01")
+        rows = [[datetime(2017, 1, 1)]]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "dates.xlsx")
+            with xlsxwriter.Workbook(path) as book:
+                sheet.book = book
+                sheet.sheet = book.add_worksheet("dates")
+                first = sheet.column_writers(rows)[0][2]
+                formats = len(book.formats)
+                second = sheet.column_writers(rows)[0][2]
+                self.eq(second is first, True)
+                self.eq(len(book.formats), formats)
+
+    def test_constant_memory(self):
+        sheet = SheetBilling(self.config, date="2017-03-01")
+        sheet._ddh = DDH(header=[
+            "Invoice Date", "Due Date", "Line Item", "Description", "Unit",
+            "Quantity", "Subtotal",
+        ], data=[
+            ["2017-01-01", "2017-01-31", "item", "Item", 1.0, 2.0, 2.0],
+            ["2017-02-01", "2017-02-28", "item", "Item", 1.0, 3.0, 3.0],
+        ])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "streamed.xlsx")
+            with warnings.catch_warnings():
+                warnings.simplefilter("error")
+                with xlsxwriter.Workbook(
+                    path, {"constant_memory": True}
+                ) as book:
+                    self.eq(bool(sheet.to_xlsx(book)), True)
+                    self.eq(sheet.streaming, True)
+            self.eq(os.path.getsize(path) > 0, True)
+
+
+class TestZephyrDeltas(ZephyrTestCase):
+
+    def test_compute_details_delta(self):
+        def instance(instance_id, status="running", cpu=1.0, tags=()):
+            return dict(
+                InstanceId=instance_id, InstanceName=instance_id,
+                Status=status, AvgCpuforLast7Days=cpu,
+                ResourceTags=[dict(Key=k, Value=v) for k, v in tags],
+            )
+        tags = (("Name", "web"), ("lw:environment", "prod"))
+        stable = [instance("i-{}".format(n)) for n in range(6, 9)]
+        base = [
+            instance("i-1"), instance("i-2"), instance("i-3"),
+            instance("i-5", tags=tags),
+        ] + stable
+        # Only metrics and the order of tags change for i-1 and i-5.
+        current = [
+            instance("i-1", cpu=2.0), instance("i-2", "stopped"),
+            instance("i-5", tags=reversed(tags)),
+        ] + stable + [instance("i-4")]
+        with tempfile.TemporaryDirectory() as cache_root:
+            self.config.set("zephyr", "ZEPHYR_CACHE_ROOT", cache_root)
+            self.config.set("zephyr", "ZEPHYR_CACHE_DELTAS", "1")
+            client = ComputeDetails(config=self.config, log=self.log)
+            client.ZEPHYR_S3_BUCKET = None
+            client.sync_manifest = lambda: False
+            cache_base, cache_local = [
+                os.path.join(cache_root, client.cache_key("acct", date))
+                for date in ("2001-01-01", "2001-02-01")
+            ]
+            for path in (cache_base, cache_local):
+                os.makedirs(os.path.dirname(path))
+            cache.write(
+                cache_base, json.dumps(dict(HasNext=False, Ec2Instances=base))
+            )
+            response = json.dumps(dict(HasNext=False, Ec2Instances=current))
+            client.write_entry(
+                "acct", "2001-02-01", cache_local, None, response
+            )
+            delta = ComputeDetails.get_delta(cache.read(cache_local))
+            self.eq(delta["base_date"], "2001-01-01")
+            self.eq(delta["removed"], ["i-3"])
+            self.eq(
+                sorted(client.instances(cache.read(cache_local)).values(),
+                    key=lambda item: item["InstanceId"]),
+                sorted([base[0], current[1], base[3]] + stable + [current[-1]],
+                    key=lambda item: item["InstanceId"]),
+            )
+            self.eq(client.churn("acct", "2001-02-01"), dict(
+                added={"i-4"}, removed={"i-3"}, changed={"i-2"},
+            ))
+
+            # A delta whose base was replaced is fetched again in full.
+            cache.write(
+                cache_base,
+                json.dumps(dict(HasNext=False, Ec2Instances=base[:2])),
+            )
+            with self.assertRaises(StaleDelta):
+                client.instances(cache.read(cache_local))
+            client = ComputeDetails(config=self.config, log=self.log)
+            client.ZEPHYR_S3_BUCKET = None
+            client.sync_manifest = lambda: False
+            client.fill = lambda account, date, cache_key: response
+            client.load("acct", "2001-02-01", False)
+            self.eq(len(client.data), len(current))
+
+
+class TestZephyrAccounts(test.CementTestCase):
+
+    def test_account_index(self):
+        with sqlite3.connect(":memory:") as con:
+            TestZephyrFixtures._load_fixtures(con.cursor())
+            index = accounts.load_index(con)
+        self.eq(sorted(index), [".meta", ".no_dynamics"])
+        self.eq(index[".meta"], accounts.Account(
+            slug=".meta",
+            aws_account="aws_id_1",
+            project="sf_project_id_1",
+            client="Test Account",
+            cc_name="Test Account",
+            dy_name="LOGICWORKSRND",
+            lo_name="Logicworks R&D",
+        ))
+        self.eq(index[".no_dynamics"].dy_name, "")
+
+    def test_account_index_partial(self):
+        with sqlite3.connect(":memory:") as con:
+            self.eq(accounts.load_index(con), dict())
+            con.execute('CREATE TABLE sf_aws ("Name", "Acct_Number__c")')
+            con.execute("INSERT INTO sf_aws VALUES ('acct', '1')")
+            index = accounts.load_index(con)
+        self.eq(index["acct"].aws_account, "1")
+        self.eq(index["acct"].cc_name, None)
+
+
+class StubS3(object):
+    """
+    Answer list_objects_v2 pagination with one page of given keys and record
+    the batches sent to delete_objects.
+    """
+    def __init__(self, keys):
+        self.batches = []
+        self.keys = keys
+        self.puts = []
+
+    def delete_objects(self, Bucket, Delete):
+        self.batches.append([obj["Key"] for obj in Delete["Objects"]])
+        return dict()
+
+    def download_file(self, bucket, key, filename):
+        if key not in self.keys:
+            raise ClientError(dict(Error=dict(Code="404")), "HeadObject")
+        with open(filename, "w") as f:
+            f.write(key)
+
+    def get_paginator(self, operation):
+        return self
+
+    def put_object(self, ACL, Body, Bucket, Key):
+        self.puts.append(Key)
+        return dict(ETag='"etag"')
+
+    def paginate(self, Bucket, Prefix=""):
+        yield dict(Contents=[
+            dict(Key=key, Size=1, ETag='"etag"')
+            for key in self.keys
+            if key.startswith(Prefix)
+        ])
+
+
+class TestZephyrS3(test.CementTestCase):
+
+    def test_s3_client_shared(self):
+        client = aws.get_s3_client("key_id", "secret")
+        self.eq(client is aws.get_s3_client("key_id", "secret"), True)
+        self.eq(client is aws.get_s3_client("other", "secret"), False)
+
+    def test_delete_s3_batches(self):
+        keys = ["acct/2001-01/{}.json".format(i) for i in range(2500)]
+        s3 = StubS3(keys)
+        self.eq(aws.delete_s3(s3, "bucket", keys), [])
+        self.eq(sorted([len(batch) for batch in s3.batches]), [500, 1000, 1000])
+
+    def test_get_s3_silences_timeouts(self):
+        class TimeoutS3(StubS3):
+            def download_file(self, bucket, key, filename):
+                raise RetriesExceededError(
+                    ReadTimeoutError(endpoint_url="https://s3")
+                )
+        with tempfile.TemporaryDirectory() as cache_root:
+            path = os.path.join(cache_root, "billing.json")
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                self.eq(aws.get_s3(TimeoutS3([]), "bucket", "key", path), False)
+            self.eq(len(caught), 1)
+            self.eq(os.path.exists(path), False)
+
+    def test_get_s3_to_file(self):
+        s3 = StubS3(["a/2001-01/billing.json"])
+        with tempfile.TemporaryDirectory() as cache_root:
+            path = os.path.join(cache_root, "billing.json")
+            self.eq(aws.get_s3(s3, "bucket", "b/2001-01/billing.json", path), False)
+            self.eq(os.listdir(cache_root), [])
+            self.eq(aws.get_s3(s3, "bucket", "a/2001-01/billing.json", path), True)
+            self.eq(os.listdir(cache_root), ["billing.json"])
+
+    def test_list_s3_prefix(self):
+        s3 = StubS3(["a/2001-01/billing.json", "b/2001-01/billing.json"])
+        self.eq(
+            [obj["Key"] for obj in aws.list_s3(s3, "bucket", "a/")],
+            ["a/2001-01/billing.json"]
+        )
+
+
+class FlakyS3(StubS3):
+    """Fail the first put_object calls as a throttled S3 would."""
+    failures = 1
+
+    def put_object(self, ACL, Body, Bucket, Key):
+        if self.failures:
+            self.failures -= 1
+            raise ClientError(dict(Error=dict(Code="SlowDown")), "PutObject")
+        return super().put_object(ACL, Body, Bucket, Key)
+
+
+class TestZephyrUploader(ZephyrTestCase):
+
+    def test_uploader_replays_journal(self):
+        s3 = StubS3([])
+        with tempfile.TemporaryDirectory() as cache_root:
+            path = os.path.join(cache_root, "billing.json")
+            with open(path, "w") as f:
+                f.write("[]")
+            uploader = Uploader(cache_root)
+            # A journal left behind by a process which died mid-upload.
+            orphan = os.path.join(uploader.directory, "0.journal")
+            with open(orphan, "w") as f:
+                f.write('{"id": 1, "filename": "%s", "bucket": "b", '
+                        '"key": "a/2001-01/orphan.json"}\n' % path)
+            # One left by a dead process whose PID this process reuses.
+            reused = os.path.join(
+                uploader.directory, "{}.journal".format(os.getpid())
+            )
+            with open(reused, "w") as f:
+                f.write('{"id": 1, "filename": "%s", "bucket": "b", '
+                        '"key": "a/2001-01/reused.json"}\n' % path)
+            uploaded = []
+            uploader.put(
+                s3, path, "b", "a/2001-01/billing.json", self.log,
+                callback=uploaded.append,
+            )
+            uploader.drain()
+            self.eq(
+                sorted(s3.puts),
+                ["a/2001-01/billing.json", "a/2001-01/orphan.json",
+                    "a/2001-01/reused.json"]
+            )
+            self.eq(uploaded, ['"etag"'])
+            manifest = Manifest(cache_root)
+            self.ok(manifest.get("b", "a/2001-01/orphan.json"))
+            self.ok(manifest.get("b", "a/2001-01/reused.json"))
+            self.eq(os.path.exists(orphan), False)
+            self.eq(os.path.exists(reused), False)
+            self.eq(os.path.getsize(uploader.path), 0)
+
+    def test_uploader_retries(self):
+        s3 = FlakyS3([])
+        with tempfile.TemporaryDirectory() as cache_root:
+            path = os.path.join(cache_root, "billing.json")
+            with open(path, "w") as f:
+                f.write("[]")
+            uploader = Uploader(cache_root)
+            uploader.retry_delay = 0
+            uploader.put(s3, path, "b", "a/2001-01/billing.json", self.log)
+            uploader.drain()
+            self.eq(s3.puts, ["a/2001-01/billing.json"])
+            self.eq(s3.failures, 0)
+            self.eq(os.path.getsize(uploader.path), 0)
+
+
+class TestZephyrManifest(test.CementTestCase):
+
+    def test_manifest_lookups(self):
+        with tempfile.TemporaryDirectory() as cache_root:
+            manifest = Manifest(cache_root)
+            self.eq(manifest.exists("bucket", "acct/2001-01/billing.json"), None)
+            s3 = StubS3(["acct/2001-01/billing.json"])
+            self.eq(manifest.sync_once(s3, "bucket"), True)
+            self.eq(manifest.sync_once(s3, "bucket"), False)
+            self.eq(manifest.exists("bucket", "acct/2001-01/billing.json"), True)
+            self.eq(manifest.exists("bucket", "acct/2001-01/lb-idle.json"), False)
+            manifest.add("bucket", "acct/2001-01/lb-idle.json", 1, '"etag"')
+            self.eq(manifest.exists("bucket", "acct/2001-01/lb-idle.json"), True)
+            manifest.remove("bucket", ["acct/2001-01/billing.json"])
+            self.eq(manifest.exists("bucket", "acct/2001-01/billing.json"), False)
+
+    def test_manifest_evict_due(self):
+        with tempfile.TemporaryDirectory() as cache_root:
+            manifest = Manifest(cache_root)
+            self.eq(manifest.evict_due(), True)
+            self.eq(Manifest(cache_root).evict_due(), False)
 
 
 class TestZephyrParse(test.CementTestCase):
@@ -78,10 +967,9 @@ class TestZephyrParseCache(TestZephyrParse):
         client = ComputeDetails()
         client.parse(response)
         ddh = client.to_ddh()
+        index = ddh.header.index("LaunchTime")
         for row in ddh.data:
-            row[ddh.header.index("LaunchTime")] = datetime.strptime(
-                row[ddh.header.index("LaunchTime")], "%Y-%m-%dT%H:%M:%S"
-            ).strftime("%m/%d/%y %H:%M")
+            row[index] = row[index].strftime("%m/%d/%y %H:%M")
         csv_out = ddh.to_csv()
         trans_csv = csv_out.replace("\r\n", "")
 
@@ -90,6 +978,16 @@ class TestZephyrParseCache(TestZephyrParse):
         trans_gold = gold_result.replace("\n", "")
         self.eq(trans_csv, trans_gold)
 
+    def test_compute_details_json(self):
+        infile = os.path.join(self.assets, "compute-details.json")
+        with open(infile, "r") as f:
+            response = f.read()
+        client = ComputeDetails()
+        client.parse(response)
+        out = json.loads(client.to_ddh().to_json())
+        index = out["header"].index("LaunchTime")
+        self.eq(out["data"][0][index], "12/29/16 11:30")
+
     def test_compute_migration(self):
         self.assert_equal_out("compute_migration")
 
@@ -122,22 +1020,17 @@ class TestZephyrReportParse(TestZephyrParse):
             app.configure()
             config = app.config
         header = ["Status", "LaunchTime"]
-        data = [
-            ["running", "02/06/17 02:50"],
-            ["stopped", "02/06/17 02:50"],
-            ["running", "10/06/16 02:50"],
-            ["stopped", "10/06/16 02:50"],
-            ["running", "07/06/16 02:50"],
-            ["stopped", "07/06/16 02:50"],
-            ["running", "01/06/16 02:50"],
-            ["stopped", "01/06/16 02:50"]
-        ]
         launch_times_ = [
-            "02/06/17 02:50",
-            "10/06/16 02:50",
-            "07/06/16 02:50",
-            "01/06/16 02:50"
+            datetime(2017, 2, 6, 2, 50),
+            datetime(2016, 10, 6, 2, 50),
+            datetime(2016, 7, 6, 2, 50),
+            datetime(2016, 1, 6, 2, 50),
         ]
+        data = [
+            [status, launch_time]
+            for launch_time in launch_times_
+            for status in ("running", "stopped")
+        ] + [["running", ""]]
         days_90_ = 1
         days_180_ = 1
         days_270_ = 1
@@ -4,6 +4,9 @@ import json
 from decimal import Decimal
 
 DAY = datetime.timedelta(days=1)
+# ISO 8601 times as the APIs and datetime.isoformat write them. Python 3.5
+# has no datetime.fromisoformat.
+ISO_FORMATS = ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f")
 
 class ZephyrEncoder(json.JSONEncoder):
     """Serialize decimal.Decimal objects into JSON as floats."""
@@ -25,6 +28,15 @@ def first_of_previous_month(date=None):
     dlm = fom - DAY
     return datetime.datetime(year=dlm.year, month=dlm.month, day=1)
 
+def from_isoformat(value):
+    """Parse an ISO 8601 time, raising ValueError if it is not one."""
+    for fmt in ISO_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError("Not an ISO 8601 time: {}".format(value))
+
 def get_config_values(section, keys, config):
     """Get a list of configuration values from the same section."""
     return [config.get(section, key) for key in keys]
@@ -0,0 +1,138 @@
+import os
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from . import sessions
+from .pool import FAILED, SKIPPED, Summary
+from .cc.client import CloudCheckrBPC, CloudCheckrBPCs
+from .utils import ZephyrException
+
+CACHED = "cached"
+FETCHED = "fetched"
+STATUSES = (FETCHED, CACHED, SKIPPED, FAILED)
+
+# How many requests may be in flight against each backend at once.
+BACKEND_WORKERS = {
+    "CloudCheckr": 4,
+    "Dynamics": 2,
+    "Logicops": 2,
+}
+DEFAULT_BACKEND_WORKERS = 2
+
+
+def get_calls(sheets, slugs=None):
+    """
+    The unique calls the sheets need which are cached per account and
+    month, optionally only the given slugs.
+    """
+    calls = list()
+    for Sheet in sheets:
+        for Call in Sheet.calls:
+            if Call.cached_by_account and Call not in calls:
+                calls.append(Call)
+    if not slugs:
+        return calls
+    unknown = set(slugs) - {Call.slug for Call in calls}
+    if unknown:
+        raise ZephyrException("Unknown calls: {}. Choose from {}.".format(
+            ", ".join(sorted(unknown)),
+            ", ".join(sorted(Call.slug for Call in calls)),
+        ))
+    return [Call for Call in calls if Call.slug in slugs]
+
+
+class Warmer(object):
+    """
+    Fill the local and S3 caches with the responses of every call for every
+    account so that later report runs are cache hits. Each backend gets its
+    own pool of threads, so a slow backend never holds up the others and
+    none of them receives more than its share of concurrent requests.
+    """
+    def __init__(self, config, calls, log=None):
+        self.calls = calls
+        self.config = config
+        self.log = log
+
+    def warm(self, accounts, date):
+        summary = Summary(statuses=STATUSES)
+        backends = sorted({Call.name for Call in self.calls})
+        executors = {
+            name: ThreadPoolExecutor(
+                max_workers=BACKEND_WORKERS.get(name, DEFAULT_BACKEND_WORKERS)
+            )
+            for name in backends
+        }
+        # The best practice checks of an account are warmed together so
+        # that they can share one request.
+        checks = [
+            Call for Call in self.calls if issubclass(Call, CloudCheckrBPC)
+        ]
+        if len(checks) < 2:
+            checks = []
+        groups = [checks] + [
+            [Call] for Call in self.calls if Call not in checks
+        ]
+        try:
+            futures = {
+                executors[group[0].name].submit(
+                    self.warm_group, group, account, date
+                ): (group, account)
+                for account in accounts
+                for group in groups
+                if group
+            }
+            for future in as_completed(futures):
+                group, account = futures[future]
+                try:
+                    results = future.result()
+                except Exception as e:
+                    message = "{}: {}".format(type(e).__name__, e)
+                    results = [(FAILED, message)] * len(group)
+                for Call, (status, message) in zip(group, results):
+                    summary.add(
+                        "{}/{}".format(account, Call.slug), status, message
+                    )
+        finally:
+            for executor in executors.values():
+                executor.shutdown()
+        summary.add_limits(os.getpid(), sessions.limiter_stats())
+        summary.log_to(self.log)
+        return summary
+
+    def warm_group(self, calls, account, date):
+        clients = [Call(config=self.config, log=self.log) for Call in calls]
+        if len(clients) > 1:
+            # Unknown accounts and failures fall through to warm_one.
+            CloudCheckrBPCs(self.config, log=self.log).fill_checks(
+                [
+                    client for client in clients
+                    if not self.is_local(client, account, date)
+                ],
+                account,
+                date,
+            )
+        results = list()
+        for client in clients:
+            try:
+                results.append(self.warm_one(client, account, date))
+            except Exception as e:
+                results.append((FAILED, "{}: {}".format(type(e).__name__, e)))
+        return results
+
+    def is_local(self, client, account, date):
+        cache_key = client.cache_key(account, date)
+        cache_local = os.path.join(client.ZEPHYR_CACHE_ROOT, cache_key)
+        return os.path.isfile(cache_local)
+
+    def warm_one(self, client, account, date):
+        if client.response is not None:
+            return FETCHED, ""
+        if self.is_local(client, account, date):
+            return CACHED, ""
+        if not client.get_account_by_slug(account):
+            return SKIPPED, "{} does not know this account.".format(
+                client.name
+            )
+        # The cache policy downloads from S3 or requests and caches.
+        client.cache_policy(account, date, False)
+        return FETCHED, ""